@@ -0,0 +1,275 @@
+"""
+    Asyncio JSON API for conversions, runs next to the Flask app: python -m api.server
+
+    POST   /api/conversions?name=<file.pdf>   raw PDF as the request body, answers 202 with the job
+    GET    /api/conversions/<id>?wait=<s>     job status, waits up to s seconds for it to change
+    GET    /api/conversions/<id>/download     converted HTML once the job is done
+    DELETE /api/conversions/<id>              cancels the job and removes its files
+    GET    /assets/<sha256>.<ext>             images linked by documents converted with PDF2HTML_IMAGE_MODE=assets
+
+    Requests authenticate with "Authorization: Bearer <token>" or the web UI's token cookie.
+    Uploads, conversions and downloads are all driven by the event loop, an idle connection
+    only costs its socket.
+"""
+
+import os
+import re
+import json
+import time
+import uuid
+import shutil
+import asyncio
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+
+from aiohttp import web
+
+from config.processing import JOB_WORKERS, JOB_QUEUE_SIZE, JOB_TIMEOUT
+from config.conversion import ASSET_DIR
+from processors.conversion import convert_pdf_async
+from security.auth import verify_token
+from metrics import collector as metrics
+
+BASE_DIR = os.path.abspath(os.path.dirname(__file__) + "/../")
+
+API_DIR = BASE_DIR + '/storage/api'
+# Shared with the web UI, a document converted by either is a cache hit for both
+CACHE_DIR = BASE_DIR + '/storage/cache/conversion'
+
+MAX_UPLOAD_BYTES = 500 * 1024 * 1024
+CHUNK_SIZE = 1024 * 1024
+MAX_WAIT = 60
+
+_jobs = {}
+_slots = None
+
+
+async def create_conversion(request):
+    name = re.sub("[^\\w.-]+", "_", os.path.basename(request.query.get("name", "document.pdf")))
+    if os.path.splitext(name)[-1].lower() != ".pdf":
+        return _error(400, "Only .pdf files are accepted")
+    if sum(1 for job in _jobs.values() if job["info"]["status"] == "queued") >= JOB_QUEUE_SIZE:
+        return _error(503, "%d jobs are already waiting" % JOB_QUEUE_SIZE)
+
+    job_id = uuid.uuid4().hex
+    job_dir = os.path.join(API_DIR, job_id)
+    os.makedirs(job_dir)
+    input_file = os.path.join(job_dir, name)
+    size = 0
+    try:
+        with open(input_file, "wb") as f:
+            while True:
+                chunk = await request.content.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > MAX_UPLOAD_BYTES:
+                    shutil.rmtree(job_dir)
+                    return _error(413, "Uploads are limited to %d bytes" % MAX_UPLOAD_BYTES)
+                f.write(chunk)
+    except BaseException:
+        shutil.rmtree(job_dir, ignore_errors=True)
+        raise
+    if not size:
+        shutil.rmtree(job_dir)
+        return _error(400, "Empty request body")
+
+    job = {
+        "info": {"id": job_id, "name": name, "size": size, "status": "queued", "message": "",
+                 "created": time.time()},
+        "changed": asyncio.Event()
+    }
+    _jobs[job_id] = job
+    _save(job)
+    job["task"] = asyncio.ensure_future(_run(job, input_file, os.path.splitext(input_file)[0] + ".html"))
+    return web.json_response(_describe(job["info"]), status=202)
+
+
+async def get_conversion(request):
+    job = _get_job(request.match_info["job_id"])
+    if job is None:
+        return _error(404, "No such conversion")
+
+    wait = min(_float(request.query.get("wait")), MAX_WAIT)
+    if wait > 0 and job["info"]["status"] in ("queued", "running"):
+        try:
+            await asyncio.wait_for(job["changed"].wait(), wait)
+        except asyncio.TimeoutError:
+            pass
+    return web.json_response(_describe(job["info"]))
+
+
+async def download_conversion(request):
+    job = _get_job(request.match_info["job_id"])
+    if job is None:
+        return _error(404, "No such conversion")
+    if job["info"]["status"] != "done":
+        return _error(409, "Conversion is %s" % job["info"]["status"])
+
+    output_file = os.path.join(API_DIR, job["info"]["id"], os.path.splitext(job["info"]["name"])[0] + ".html")
+    return web.FileResponse(output_file, chunk_size=CHUNK_SIZE, headers={
+        "Content-Disposition": 'attachment; filename="%s"' % os.path.basename(output_file)
+    })
+
+
+async def delete_conversion(request):
+    job = _get_job(request.match_info["job_id"])
+    if job is None:
+        return _error(404, "No such conversion")
+
+    task = job.get("task")
+    if task is not None and not task.done():
+        task.cancel()
+        # The task kills pdftohtml and waits for the job's threads to be done with its files before it finishes
+        await asyncio.wait([task])
+    _jobs.pop(job["info"]["id"], None)
+    shutil.rmtree(os.path.join(API_DIR, job["info"]["id"]), ignore_errors=True)
+    return web.Response(status=204)
+
+
+async def get_asset(request):
+    fname = request.match_info["fname"]
+    path = os.path.join(ASSET_DIR, fname[:2], fname)
+    if not re.match("^[0-9a-f]{64}\\.(png|jpg|webp)$", fname) or not os.path.isfile(path):
+        return _error(404, "No such asset")
+    return web.FileResponse(path, headers={
+        "Cache-Control": "public, max-age=31536000, immutable"
+    })
+
+
+async def _run(job, input_file, output_file):
+    loop = asyncio.get_running_loop()
+    # The job's blocking steps run here, cancelling the task does not stop a step already running
+    executor = ThreadPoolExecutor(max_workers=1)
+    try:
+        async with _slots:
+            _update(job, status="running")
+            start = time.perf_counter()
+            await loop.run_in_executor(None, _record_job, {"jobs_started_total": {}})
+            outcome = {}
+            try:
+                await asyncio.wait_for(_convert(job, input_file, output_file, executor), JOB_TIMEOUT or None)
+                _update(job, status="done", finished=time.time())
+                outcome["jobs_succeeded_total"] = {}
+            except asyncio.CancelledError:
+                outcome.update(jobs_killed_total={"reason": "cancelled"}, jobs_failed_total={})
+                raise
+            except asyncio.TimeoutError:
+                _update(job, status="failed", error="Killed after running for more than %d seconds" % JOB_TIMEOUT,
+                        finished=time.time())
+                outcome.update(jobs_killed_total={"reason": "timeout"}, jobs_failed_total={})
+            except Exception as ex:
+                _update(job, status="failed", error=repr(ex), finished=time.time())
+                outcome["jobs_failed_total"] = {}
+            finally:
+                # Only done once the step still running is, DELETE removes the files it works on after this
+                await loop.run_in_executor(None, executor.shutdown)
+                await loop.run_in_executor(None, partial(
+                    _record_job, outcome, time.perf_counter() - start))
+    finally:
+        executor.shutdown(wait=False)
+        # Finished jobs are read back from their job.json when asked for
+        if _jobs.get(job["info"]["id"]) is job and job["info"]["status"] not in ("queued", "running"):
+            del _jobs[job["info"]["id"]]
+
+
+def _record_job(outcome, duration=None):
+    # The metrics file is locked and rewritten, not something to do on the event loop
+    for name, labels in outcome.items():
+        metrics.inc("pdf2html_" + name, **labels)
+    if duration is not None:
+        metrics.observe("pdf2html_job_duration_seconds", duration)
+
+
+async def _convert(job, input_file, output_file, executor):
+    async for line in convert_pdf_async(input_file, output_file, CACHE_DIR, executor):
+        _update(job, message=line)
+
+
+def _update(job, **fields):
+    job["info"].update(fields)
+    _save(job)
+    # Wake up the long polls waiting on this job, later ones wait for the next change
+    job["changed"].set()
+    job["changed"] = asyncio.Event()
+
+
+def _save(job):
+    with open(os.path.join(API_DIR, job["info"]["id"], "job.json"), "w") as f:
+        json.dump(job["info"], f)
+
+
+def _get_job(job_id):
+    if job_id in _jobs:
+        return _jobs[job_id]
+    # Finished jobs outlive the process through their job.json
+    job_file = os.path.join(API_DIR, job_id, "job.json")
+    if not re.match("^[0-9a-f]{32}$", job_id) or not os.path.exists(job_file):
+        return None
+    with open(job_file) as f:
+        info = json.load(f)
+    if info["status"] in ("queued", "running"):
+        info.update(status="failed", error="Interrupted by a server restart")
+    return {"info": info, "changed": asyncio.Event()}
+
+
+def _describe(info):
+    description = dict(info, url="/api/conversions/%s" % info["id"])
+    if info["status"] == "done":
+        description["download_url"] = "/api/conversions/%s/download" % info["id"]
+    return description
+
+
+def _float(value):
+    try:
+        return float(value or 0)
+    except ValueError:
+        return 0
+
+
+def _error(status, message):
+    return web.json_response({"error": message}, status=status)
+
+
+@web.middleware
+async def authenticate(request, handler):
+    if request.path.startswith("/assets/"):
+        # Public like the web UI's, an asset can only be found through a document linking it
+        return await handler(request)
+    header = request.headers.get("Authorization", "")
+    if (header.startswith("Bearer ") and verify_token(header[len("Bearer "):], False)) \
+            or verify_token(request.cookies.get("token")):
+        return await handler(request)
+    return _error(401, "Missing or invalid token")
+
+
+async def _start(app):
+    global _slots
+    # Conversions running at the same time, the rest wait here for a slot
+    _slots = asyncio.Semaphore(JOB_WORKERS)
+
+
+async def _cancel_jobs(app):
+    for job in _jobs.values():
+        if job.get("task") is not None:
+            job["task"].cancel()
+
+
+def create_app():
+    for d in [API_DIR, CACHE_DIR]:
+        if not os.path.exists(d):
+            os.makedirs(d)
+
+    app = web.Application(middlewares=[authenticate])
+    app.router.add_post('/api/conversions', create_conversion)
+    app.router.add_get('/api/conversions/{job_id}', get_conversion)
+    app.router.add_get('/api/conversions/{job_id}/download', download_conversion)
+    app.router.add_delete('/api/conversions/{job_id}', delete_conversion)
+    app.router.add_get('/assets/{fname}', get_asset)
+    app.on_startup.append(_start)
+    app.on_shutdown.append(_cancel_jobs)
+    return app
+
+
+if __name__ == "__main__":
+    web.run_app(create_app(), host='0.0.0.0', port=int(os.environ.get("API_PORT", 8081)))
@@ -0,0 +1,104 @@
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+from helpers.functions import locked_json
+
+# Bump when the post-processing (e.g. h# tag detection) changes so old entries are ignored
+CACHE_FORMAT = 1
+
+# Files an entry is made of, the html and optionally its page records
+ENTRY_SUFFIXES = ('.html', '.ndjson')
+
+
+def cache_key(pdf_path, options, poppler_version):
+    h = hashlib.sha256()
+    with open(pdf_path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(block)
+    h.update(json.dumps([CACHE_FORMAT, poppler_version, options], sort_keys=True).encode('utf8'))
+    return h.hexdigest()
+
+
+def fetch(cache_dir, key, output_file, records_file=None):
+    """Copies the cached html to output_file, and its page records to records_file if given, False on a miss"""
+    entry = os.path.join(cache_dir, key + '.html')
+    records_entry = os.path.join(cache_dir, key + '.ndjson')
+    try:
+        if records_file and not os.path.exists(records_entry):
+            raise FileNotFoundError(records_entry)
+        shutil.copyfile(entry, output_file)
+        # mtime is the LRU clock
+        os.utime(entry)
+        if records_file:
+            shutil.copyfile(records_entry, records_file)
+            os.utime(records_entry)
+    except FileNotFoundError:
+        _bump(cache_dir, 'misses')
+        return False
+    _bump(cache_dir, 'hits')
+    return True
+
+
+def store(cache_dir, key, output_file, max_bytes, records_file=None):
+    for path, suffix in ((output_file, '.html'), (records_file, '.ndjson')):
+        if not path:
+            continue
+        fd, temp_entry = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+        os.close(fd)
+        shutil.copyfile(path, temp_entry)
+        os.replace(temp_entry, os.path.join(cache_dir, key + suffix))
+    evict(cache_dir, max_bytes)
+
+
+def evict(cache_dir, max_bytes):
+    entries = []
+    total = 0
+    for name in os.listdir(cache_dir):
+        if not name.endswith(ENTRY_SUFFIXES):
+            continue
+        try:
+            st = os.stat(os.path.join(cache_dir, name))
+        except FileNotFoundError:
+            continue
+        entries.append((st.st_mtime, st.st_size, name))
+        total += st.st_size
+
+    entries.sort()
+    evicted = 0
+    for mtime, size, name in entries:
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(os.path.join(cache_dir, name))
+        except FileNotFoundError:
+            pass
+        total -= size
+        evicted += 1
+
+    if evicted:
+        _bump(cache_dir, 'evictions', evicted)
+
+
+def stats(cache_dir):
+    counters = {'hits': 0, 'misses': 0, 'evictions': 0}
+    with _locked_stats(cache_dir, write=False) as saved:
+        counters.update(saved)
+    counters['entries'] = 0
+    counters['bytes'] = 0
+    for name in os.listdir(cache_dir):
+        if name.endswith(ENTRY_SUFFIXES):
+            counters['entries'] += name.endswith('.html')
+            counters['bytes'] += os.path.getsize(os.path.join(cache_dir, name))
+    return counters
+
+
+def _bump(cache_dir, counter, n=1):
+    with _locked_stats(cache_dir) as counters:
+        counters[counter] = counters.get(counter, 0) + n
+
+
+def _locked_stats(cache_dir, write=True):
+    # Counters live in a file since conversions run in separate worker processes
+    return locked_json(os.path.join(cache_dir, 'stats.json'), {}, write)
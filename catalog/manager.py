@@ -0,0 +1,97 @@
+import os
+import hashlib
+import sqlite3
+from contextlib import contextmanager
+from helpers.functions import mkdir_p
+from config.files import CATALOG_FILE
+
+SORT_COLUMNS = {"name": "name", "size": "size", "date": "mtime"}
+
+# Precompressed copies stored next to the files, see compression.manager
+VARIANT_SUFFIXES = (".gz", ".br", ".tmp")
+
+
+def path_for(location, fname):
+    """Where fname lives under location, files are spread over 256 subdirectories by a hash of their name"""
+    return os.path.join(location, bucket(fname), fname)
+
+
+def bucket(fname):
+    return hashlib.md5(fname.encode("utf8", "surrogateescape")).hexdigest()[:2]
+
+
+def add(location, fname):
+    """Indexes fname after it was written to path_for(location, fname)"""
+    st = os.stat(path_for(location, fname))
+    with _connect() as db:
+        db.execute("INSERT OR REPLACE INTO files (location, name, size, mtime) VALUES (?, ?, ?, ?)",
+                   (location, fname, st.st_size, st.st_mtime))
+
+
+def remove(location, fname):
+    with _connect() as db:
+        db.execute("DELETE FROM files WHERE location = ? AND name = ?", (location, fname))
+
+
+def list_files(location, page=1, per_page=100, sort="name", descending=False, query=None):
+    """One page of the files under location as (name, size, mtime) rows, and the number of matching files"""
+    where = "location = ?"
+    params = [location]
+    if query:
+        where += " AND name LIKE ? ESCAPE '\\'"
+        params.append("%" + query.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%")
+    order = "%s %s, name" % (SORT_COLUMNS.get(sort, "name"), "DESC" if descending else "ASC")
+    with _connect() as db:
+        total = db.execute("SELECT COUNT(*) FROM files WHERE " + where, params).fetchone()[0]
+        rows = db.execute("SELECT name, size, mtime FROM files WHERE %s ORDER BY %s LIMIT ? OFFSET ?"
+                          % (where, order), params + [per_page, (max(page, 1) - 1) * per_page]).fetchall()
+    return rows, total
+
+
+def sync(location):
+    """
+        Moves files found directly in location into their subdirectory (layout before the catalog)
+        and rebuilds the index of location from what is on disk
+    """
+    for entry in os.scandir(location):
+        if entry.is_file():
+            target = path_for(location, entry.name)
+            mkdir_p(os.path.dirname(target))
+            os.replace(entry.path, target)
+
+    rows = []
+    for sub in os.scandir(location):
+        if sub.is_dir() and len(sub.name) == 2:
+            for entry in os.scandir(sub.path):
+                if entry.is_file() and not entry.name.endswith(VARIANT_SUFFIXES):
+                    st = entry.stat()
+                    rows.append((location, entry.name, st.st_size, st.st_mtime))
+
+    with _connect() as db:
+        db.execute("DELETE FROM files WHERE location = ?", (location,))
+        db.executemany("INSERT OR REPLACE INTO files (location, name, size, mtime) VALUES (?, ?, ?, ?)", rows)
+
+
+@contextmanager
+def _connect():
+    db = sqlite3.connect(CATALOG_FILE, timeout=30)
+    try:
+        # Commits when the block succeeds, rolls back when it raises
+        with db:
+            yield db
+    finally:
+        db.close()
+
+
+def _init():
+    mkdir_p(os.path.dirname(CATALOG_FILE))
+    with _connect() as db:
+        # WAL lets the web app read while the job workers write
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("CREATE TABLE IF NOT EXISTS files (location TEXT, name TEXT, size INTEGER, mtime REAL, "
+                   "PRIMARY KEY (location, name))")
+        db.execute("CREATE INDEX IF NOT EXISTS files_size ON files (location, size)")
+        db.execute("CREATE INDEX IF NOT EXISTS files_mtime ON files (location, mtime)")
+
+
+_init()
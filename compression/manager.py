@@ -0,0 +1,57 @@
+import os
+import gzip
+import shutil
+from config.conversion import PRECOMPRESS
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+CHUNK_SIZE = 1024 * 1024
+
+# Content-Encoding -> suffix of the variant next to the original file
+SUFFIXES = {"br": ".br", "gzip": ".gz"}
+
+
+def precompress(path, encodings=None):
+    """Writes path.gz (and path.br when brotli is installed) next to path, returns the encodings written"""
+    written = []
+    for encoding in (PRECOMPRESS if encodings is None else encodings):
+        if encoding not in SUFFIXES or (encoding == "br" and brotli is None):
+            continue
+        variant = path + SUFFIXES[encoding]
+        with open(path, 'rb') as src, open(variant + '.tmp', 'wb') as dst:
+            if encoding == "gzip":
+                # mtime=0 so the same output always compresses to the same bytes
+                with gzip.GzipFile(fileobj=dst, mode='wb', compresslevel=9, mtime=0) as gz:
+                    shutil.copyfileobj(src, gz, CHUNK_SIZE)
+            else:
+                compressor = brotli.Compressor(quality=9)
+                for block in iter(lambda: src.read(CHUNK_SIZE), b''):
+                    dst.write(compressor.process(block))
+                dst.write(compressor.finish())
+        os.replace(variant + '.tmp', variant)
+        written.append(encoding)
+    return written
+
+
+def negotiate(path, accept_encodings):
+    """
+        The variant of path to send for the request's Accept-Encoding (werkzeug's request.accept_encodings)
+        as (path, encoding), encoding None for path itself
+    """
+    best = (path, None)
+    best_quality = 0
+    for encoding, suffix in SUFFIXES.items():
+        quality = accept_encodings[encoding]
+        if quality > best_quality and os.path.exists(path + suffix) \
+                and os.path.getmtime(path + suffix) >= os.path.getmtime(path):
+            best, best_quality = (path + suffix, encoding), quality
+    return best
+
+
+def remove_variants(path):
+    for suffix in SUFFIXES.values():
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
@@ -0,0 +1,61 @@
+import os
+from config.processing import JOB_WORKERS
+
+# Number of pdftohtml processes a single document is split across. JOB_WORKERS jobs run at once, each gets
+# its share of the cpus by default.
+PAGE_WORKERS = int(os.environ.get("PDF2HTML_PAGE_WORKERS", max((os.cpu_count() or 1) // JOB_WORKERS, 1)))
+
+# Number of ZIP archive members converted side by side, one pdftohtml process each. Also a share of the cpus.
+BATCH_WORKERS = int(os.environ.get("PDF2HTML_BATCH_WORKERS", max((os.cpu_count() or 1) // JOB_WORKERS, 1)))
+
+# Upper bound for the converted HTML kept in CACHE_DIR, least recently used entries are evicted first
+CACHE_MAX_BYTES = int(os.environ.get("PDF2HTML_CACHE_MAX_MB", 2048)) * 1024 * 1024
+
+# h# tag detection engine: "stream" (event driven, flat memory), "soup" (BeautifulSoup DOM)
+# or "xml" (levels ranked by font size from a pdftohtml -xml run, no <b> or numbering heuristics)
+TAG_ENGINE = os.environ.get("PDF2HTML_TAG_ENGINE", "stream")
+
+# Paragraphs repeated at the same position on most pages (running headers, footers, page numbers):
+# "mark" adds the pdf2html-repeated class and keeps them out of the h# tags, "drop" removes them, "" keeps them
+STRIP_REPEATED = os.environ.get("PDF2HTML_STRIP_REPEATED", "mark")
+
+# Limits for every pdftohtml process, the kernel kills it when it goes over (0 disables)
+PDFTOHTML_CPU_SECONDS = int(os.environ.get("PDF2HTML_CPU_SECONDS", 600))
+PDFTOHTML_MEMORY_BYTES = int(os.environ.get("PDF2HTML_MEMORY_MB", 4096)) * 1024 * 1024
+
+# Precompressed variants written next to every converted file, "br" needs the brotli package
+PRECOMPRESS = [e for e in os.environ.get("PDF2HTML_PRECOMPRESS", "gzip,br").split(",") if e]
+
+# How images reach the html: "embed" inlines them as base64, "assets" links them from a
+# content-addressed store shared by all documents (ASSET_DIR, served under ASSET_URL)
+IMAGE_MODE = os.environ.get("PDF2HTML_IMAGE_MODE", "embed")
+ASSET_DIR = os.environ.get("PDF2HTML_ASSET_DIR", os.path.abspath(
+    os.path.join(os.path.dirname(__file__), "..", "storage", "assets")))
+ASSET_URL = "/assets/"
+
+# Re-encodes the images before they are embedded or stored (1 enables, needs the Pillow package): downscaled
+# to fit IMAGE_MAX_SIZE pixels per side (0 keeps their size), converted to IMAGE_FORMAT ("webp", "jpeg", "png"
+# or "" to keep theirs) at IMAGE_QUALITY, on one thread per core. An image that does not get smaller is kept.
+IMAGE_OPTIMIZE = int(os.environ.get("PDF2HTML_IMAGE_OPTIMIZE", 0))
+IMAGE_MAX_SIZE = int(os.environ.get("PDF2HTML_IMAGE_MAX_SIZE", 1600))
+IMAGE_FORMAT = os.environ.get("PDF2HTML_IMAGE_FORMAT", "webp")
+IMAGE_QUALITY = int(os.environ.get("PDF2HTML_IMAGE_QUALITY", 80))
+
+# Writes <name>.ndjson next to every converted <name>.html, one record per page with its text boxes,
+# coordinates, fonts and h# levels (1 enables). Costs a text only pdftohtml -xml run unless TAG_ENGINE
+# is "xml", which shares its own
+PAGE_RECORDS = int(os.environ.get("PDF2HTML_PAGE_RECORDS", 0))
+
+# Pages converted by the preview profile, shown while the full conversion waits for a worker.
+# Requests may ask for up to PREVIEW_MAX_PAGES, previews are converted in the web app's request thread.
+PREVIEW_PAGES = int(os.environ.get("PDF2HTML_PREVIEW_PAGES", 3))
+PREVIEW_MAX_PAGES = int(os.environ.get("PDF2HTML_PREVIEW_MAX_PAGES", 10))
+
+# Previews the web app converts at the same time, a preview asked for beyond that fails right away
+PREVIEW_WORKERS = int(os.environ.get("PDF2HTML_PREVIEW_WORKERS", 2))
+
+# Documents the web app streams page by page at the same time, in its own threads outside the job queue
+STREAM_WORKERS = int(os.environ.get("PDF2HTML_STREAM_WORKERS", 2))
+
+# Largest chunk a streamed document is converted in, chunks start at one page and double up to it
+STREAM_MAX_CHUNK_PAGES = int(os.environ.get("PDF2HTML_STREAM_MAX_CHUNK_PAGES", 16))
@@ -0,0 +1,11 @@
+import os
+
+# SQLite index of the uploaded and processed files, see catalog.manager
+CATALOG_FILE = os.environ.get("PDF2HTML_CATALOG_FILE", os.path.abspath(
+    os.path.join(os.path.dirname(__file__), "..", "storage", "catalog.sqlite")))
+
+# Rows per page in the file views
+FILES_PER_PAGE = int(os.environ.get("PDF2HTML_FILES_PER_PAGE", 100))
+
+# Resumable uploads (and staged upload parts) not written to for this long are removed
+PARTIAL_UPLOAD_TTL = int(os.environ.get("PDF2HTML_PARTIAL_UPLOAD_HOURS", 24)) * 3600
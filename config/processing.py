@@ -0,0 +1,20 @@
+import os
+
+# Conversions running at the same time, further jobs wait in the queue
+JOB_WORKERS = int(os.environ.get("PDF2HTML_JOB_WORKERS", 2))
+
+# Jobs allowed to wait for a worker before new ones are rejected
+JOB_QUEUE_SIZE = int(os.environ.get("PDF2HTML_JOB_QUEUE_SIZE", 100))
+
+# Shared by the app and the worker processes, see metrics.collector
+METRICS_FILE = os.environ.get("PDF2HTML_METRICS_FILE", os.path.abspath(
+    os.path.join(os.path.dirname(__file__), "..", "storage", "metrics", "metrics.json")))
+
+# Bearer token a scraper may send to /metrics instead of the app's token, unset to accept the app's only
+METRICS_TOKEN = os.environ.get("PDF2HTML_METRICS_TOKEN", "")
+
+# Wall clock seconds a job may run before it is killed and its worker freed (0 disables)
+JOB_TIMEOUT = int(os.environ.get("PDF2HTML_JOB_TIMEOUT", 1800))
+
+# Seconds a killed job gets to clean up after SIGTERM before it is sent SIGKILL
+JOB_KILL_GRACE = int(os.environ.get("PDF2HTML_JOB_KILL_GRACE", 5))
@@ -1,5 +1,15 @@
 import os
-from flask import flash, render_template
+import re
+import time
+import mimetypes
+from flask import flash, render_template, jsonify, request, send_file, abort
+from catalog import manager as catalog
+from compression import manager as compression
+from config.files import FILES_PER_PAGE
+from helpers.pdf2html import pdfinfo_cached, PDFPageCountError, PopplerNotInstalledError
+
+# Page records written next to the converted html, see processors.conversion
+mimetypes.add_type("application/x-ndjson", ".ndjson")
 
 
 def delete_file(location, fname):
@@ -7,13 +17,71 @@ def delete_file(location, fname):
         return "DEBUG"
     else:
         fname = fname.strip('.')
-        os.remove(os.path.join(location, fname))
+        os.remove(catalog.path_for(location, fname))
+        compression.remove_variants(catalog.path_for(location, fname))
+        catalog.remove(location, fname)
         flash('File %s deleted.' % fname)
         
         
+def download_file(location, fname):
+    """
+        Sends fname, precompressed when the client accepts it, with an ETag per variant
+        and conditional / Range request support
+    """
+    fname = fname.strip('.')
+    path = catalog.path_for(location, fname)
+    if not os.path.isfile(path):
+        abort(404)
+    variant, encoding = compression.negotiate(path, request.accept_encodings)
+    response = send_file(variant, mimetype=mimetypes.guess_type(fname)[0] or 'application/octet-stream',
+                         conditional=True)
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.headers['Vary'] = 'Accept-Encoding'
+    # Cached copies are revalidated, a file can be converted again under the same name
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
+def download_asset(asset_dir, fname):
+    """Sends a content-addressed asset, its name changes with its content so it can be cached forever"""
+    if not re.match("^[0-9a-f]{64}\\.(png|jpg|webp)$", fname):
+        abort(404)
+    path = os.path.join(asset_dir, fname[:2], fname)
+    if not os.path.isfile(path):
+        abort(404)
+    response = send_file(path, mimetype=mimetypes.guess_type(fname)[0], conditional=True)
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
+
+
 def view_files(location, actions, title, header):
+    """Lists one page of location from the catalog, ?page=, ?sort=(name|size|date), ?desc=1 and ?q= pick which"""
+    page = max(request.args.get('page', 1, type=int), 1)
+    sort = request.args.get('sort', 'name')
+    descending = bool(request.args.get('desc', 0, type=int))
+    query = request.args.get('q', '')
+    rows, total = catalog.list_files(location, page, FILES_PER_PAGE, sort, descending, query)
     files = []
-    for file in os.listdir(location):
-        sz = os.path.getsize(os.path.join(location, file))
-        files.append((file, "%.2f MB" % (sz / 1024 / 1024), actions))
-    return render_template('files.html', files=files, title=title, header=header)
\ No newline at end of file
+    for file, sz, mtime in rows:
+        files.append((file, "%.2f MB" % (sz / 1024 / 1024), time.strftime("%Y-%m-%d %H:%M", time.localtime(mtime)),
+                      actions))
+    return render_template('files.html', files=files, title=title, header=header, total=total, page=page,
+                           pages=max(-(-total // FILES_PER_PAGE), 1), sort=sort, desc=descending, q=query)
+
+
+def file_info(location, fname):
+    fname = fname.strip('.')
+    path = catalog.path_for(location, fname)
+    if not os.path.isfile(path):
+        return jsonify({"error": "File not found"}), 404
+    try:
+        info = pdfinfo_cached(path)
+    except (PDFPageCountError, PopplerNotInstalledError) as ex:
+        return jsonify({"error": str(ex)}), 400
+    return jsonify({
+        "pages": info["Pages"],
+        "size": os.path.getsize(path),
+        "encrypted": info.get("Encrypted", "no").startswith("yes"),
+        "pdfinfo": info
+    })
@@ -1,5 +1,8 @@
 import os
+import json
+import fcntl
 import errno
+from contextlib import contextmanager
 
 
 def mkdir_p(path):
@@ -11,6 +14,30 @@ def mkdir_p(path):
         else:
             raise
 
+@contextmanager
+def locked_json(path, default, write=True):
+    """
+        Yields the json value stored in path (default while there is none) under an exclusive lock,
+        for files updated from several processes, and writes it back once the block succeeds
+        unless write is False
+    """
+    with open(path, 'a+') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            f.seek(0)
+            data = f.read()
+            value = json.loads(data) if data else default
+            yield value
+            if write:
+                f.seek(0)
+                f.truncate()
+                json.dump(value, f)
+                # Written out before the lock goes, not when the file is closed
+                f.flush()
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
 def zipdir(path, ziph):
     # ziph is zipfile handle
     for root, dirs, files in os.walk(path):
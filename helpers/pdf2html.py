@@ -3,6 +3,7 @@
     PDFs into html file(s) and is originally a fork of pdf2image
 """
 
+import io
 import os
 import re
 import platform
@@ -12,11 +13,31 @@ import random
 import shutil
 import pathlib
 import base64
-
-from subprocess import Popen, PIPE
+import hashlib
+import asyncio
+import resource
+
+from subprocess import Popen, PIPE, DEVNULL
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from functools import lru_cache, partial
+from contextlib import contextmanager
+import time
+import threading
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
 
 PDFINFO_CONVERT_TO_INT = ["Pages"]
 
+# Files whose pdfinfo output is kept in memory by pdfinfo_cached
+PDFINFO_CACHE_SIZE = 4096
+
+_pdfinfo_cache = OrderedDict()
+_pdfinfo_cache_lock = threading.Lock()
+
 
 def convert_from_path(
     pdf_path,
@@ -47,7 +68,15 @@ def convert_from_path(
     no_paragraph_merge=None,
     override_drm=None,
     word_break=None,
-    use_font_full_name=None
+    use_font_full_name=None,
+    parallel=None,
+    pages_per_chunk=None,
+    timings=None,
+    cpu_limit=None,
+    memory_limit=None,
+    asset_dir=None,
+    asset_url="",
+    optimize_images=None
 ):
     """
         Description: Convert PDF to Image will throw whenever one of the condition is reached
@@ -67,6 +96,18 @@ def convert_from_path(
             grayscale -> Output grayscale image(s)
             size -> Size of the resulting image(s), uses the Pillow (width, height) standard
             paths_only -> Don't load image(s), return paths instead (requires output_folder)
+            parallel -> Number of pdftohtml processes to split the page range across (True for one per core),
+                        only supported for single_file with no_frames
+            pages_per_chunk -> Pages per pdftohtml process in parallel mode (defaults to an even split)
+            timings -> Dict that receives the seconds spent per stage (pdfinfo, staging, pdftohtml, postprocess, output)
+                       and the peak memory of the pdftohtml process(es) as pdftohtml_peak_rss_bytes
+            cpu_limit -> CPU seconds each pdftohtml process may use before it is killed
+            memory_limit -> Address space in bytes each pdftohtml process may allocate
+            asset_dir -> Moves the images into this content-addressed store (<sha256[:2]>/<sha256>.<ext>,
+                         shared between documents) instead of next to the html, replaces embed_images
+            asset_url -> Prefix the html links the stored images with, followed by <sha256>.<ext>
+            optimize_images -> Options of optimize_images (max_size, fmt, quality, workers) to run the images
+                               through before they are embedded or stored, needs Pillow
     """
 
     # We make sure that if passed arguments are Path objects, they're converted to strings
@@ -83,7 +124,8 @@ def convert_from_path(
         print("embed_images currently only supported for single_file")
         embed_images = False
 
-    page_count = pdfinfo_from_path(pdf_path, userpw, poppler_path=poppler_path)["Pages"]
+    with _timed(timings, "pdfinfo"):
+        page_count = pdfinfo_cached(pdf_path, userpw, poppler_path=poppler_path)["Pages"]
 
     final_extension = "html"
     if xml:
@@ -101,53 +143,213 @@ def convert_from_path(
     auto_temp_dir = False
 
     temp_output_folder = tempfile.mkdtemp()
+    try:
+        # Recalculate page count based on first and last page
+        page_count = last_page - first_page + 1
 
-    # Recalculate page count based on first and last page
-    page_count = last_page - first_page + 1
-
-    args = [_get_command_path("pdftohtml", poppler_path)]
-
-    file_name = ".".join(os.path.basename(pdf_path).split('.')[:-1])
-    temp_pdf_path = os.path.abspath(os.path.join(temp_output_folder, file_name)) + ".pdf"
-
-    shutil.copyfile(pdf_path, temp_pdf_path)
-
-    args = _build_command(
-        args,
-        temp_pdf_path,
-        first_page,
-        last_page,
-        dotpdf_to_link,
-        complex_styles,
-        single_file,
-        no_images,
-        no_frames,
-        zoom,
-        xml,
-        no_coord_rounding,
-        output_encoding,
-        ownerpw,
-        userpw,
-        include_hidden,
-        image_fmt,
-        no_paragraph_merge,
-        override_drm,
-        word_break,
-        use_font_full_name,
-    )
-    # Add poppler path to LD_LIBRARY_PATH
-    env = os.environ.copy()
-    if poppler_path is not None:
-        env["LD_LIBRARY_PATH"] = poppler_path + ":" + env.get("LD_LIBRARY_PATH", "")
+        file_name = os.path.splitext(os.path.basename(pdf_path))[0]
+        temp_pdf_path = os.path.abspath(os.path.join(temp_output_folder, file_name)) + ".pdf"
 
-    # Spawn the process and save its uuid
-    process = Popen(args, env=env, stdout=PIPE, stderr=PIPE)
+        with _timed(timings, "staging"):
+            _stage_input(pdf_path, temp_pdf_path)
 
-    data, err = process.communicate()
+        def build_args(first, last):
+            return _build_command(
+                [_get_command_path("pdftohtml", poppler_path)],
+                temp_pdf_path,
+                first,
+                last,
+                dotpdf_to_link,
+                complex_styles,
+                single_file,
+                no_images,
+                no_frames,
+                zoom,
+                xml,
+                no_coord_rounding,
+                output_encoding,
+                ownerpw,
+                userpw,
+                include_hidden,
+                image_fmt,
+                no_paragraph_merge,
+                override_drm,
+                word_break,
+                use_font_full_name,
+            )
 
-    if err and strict:
-        raise PDFPopplerError()
+        # Add poppler path to LD_LIBRARY_PATH
+        env = os.environ.copy()
+        if poppler_path is not None:
+            env["LD_LIBRARY_PATH"] = poppler_path + ":" + env.get("LD_LIBRARY_PATH", "")
+
+        if parallel and (xml or not (single_file and no_frames)):
+            print("parallel currently only supported for single_file with no_frames")
+            parallel = None
+
+        page_ranges = [(first_page, last_page)]
+        if parallel:
+            workers = (os.cpu_count() or 1) if parallel is True else parallel
+            page_ranges = _split_page_range(first_page, last_page, workers, pages_per_chunk)
+
+        with _timed(timings, "pdftohtml"):
+            if len(page_ranges) > 1:
+                peak_rss = _convert_ranges(build_args, page_ranges, workers, temp_output_folder, file_name, env, strict,
+                                           (cpu_limit, memory_limit))
+            else:
+                peak_rss = _run_pdftohtml(build_args(first_page, last_page), env, strict, (cpu_limit, memory_limit))
+        if timings is not None and peak_rss is not None:
+            timings["pdftohtml_peak_rss_bytes"] = peak_rss
+
+        if title_from_file_name:
+            title = file_name
+
+        _finish_conversion(temp_output_folder, file_name, temp_pdf_path, output_file, output_folder, single_file,
+                           embed_images, center_pages, title, no_bg_color, timings,
+                           asset_dir=asset_dir, asset_url=asset_url, optimize_images=optimize_images)
+    finally:
+        # Also runs when the conversion fails or the job is cancelled
+        shutil.rmtree(temp_output_folder, ignore_errors=True)
 
+
+async def convert_from_path_async(
+    pdf_path,
+    output_folder=None,
+    output_file=None,
+    poppler_path=None,
+    strict=False,
+    title=None,
+    title_from_file_name=False,
+    embed_images=False,
+    center_pages=False,
+    no_bg_color=False,
+    first_page=None,
+    last_page=None,
+    userpw=None,
+    timeout=None,
+    timings=None,
+    cpu_limit=None,
+    memory_limit=None,
+    asset_dir=None,
+    asset_url="",
+    optimize_images=None,
+    executor=None,
+    **options
+):
+    """
+        convert_from_path for asyncio: pdfinfo and pdftohtml run as asyncio subprocesses and the
+        post-processing in executor (the loop's default one if None), so no thread waits on pdftohtml.
+        Parameters are those of convert_from_path, other options are passed on to _build_command
+        (single_file, no_frames, zoom, ...). Parallel page ranges are not supported.
+            timeout -> Seconds pdftohtml may run before it is killed and asyncio.TimeoutError raised
+    """
+    if embed_images and not options.get("single_file"):
+        print("embed_images currently only supported for single_file")
+        embed_images = False
+
+    with _timed(timings, "pdfinfo"):
+        page_count = (await pdfinfo_from_path_async(pdf_path, userpw, poppler_path=poppler_path))["Pages"]
+
+    if first_page is None:
+        first_page = 1
+
+    if last_page is None or last_page > page_count:
+        last_page = page_count
+
+    if first_page > last_page:
+        return []
+
+    temp_output_folder = tempfile.mkdtemp()
+    try:
+        file_name = os.path.splitext(os.path.basename(pdf_path))[0]
+        temp_pdf_path = os.path.abspath(os.path.join(temp_output_folder, file_name)) + ".pdf"
+
+        with _timed(timings, "staging"):
+            _stage_input(pdf_path, temp_pdf_path)
+
+        args = _build_command([_get_command_path("pdftohtml", poppler_path)], temp_pdf_path, first_page, last_page,
+                              userpw=userpw, **options)
+        limits = (cpu_limit, memory_limit)
+        with _timed(timings, "pdftohtml"):
+            process = await asyncio.create_subprocess_exec(
+                *_limit_command(args, limits), env=_poppler_env(poppler_path), stdout=DEVNULL, stderr=PIPE)
+            try:
+                _limit_process(process.pid, args, limits)
+                _, err = await asyncio.wait_for(process.communicate(), timeout)
+            except BaseException:
+                # Timed out, or the awaiting task was cancelled
+                if process.returncode is None:
+                    process.kill()
+                    await process.wait()
+                raise
+        _check_pdftohtml(process, err, strict)
+
+        if title_from_file_name:
+            title = file_name
+
+        await asyncio.get_running_loop().run_in_executor(executor, partial(
+            _finish_conversion, temp_output_folder, file_name, temp_pdf_path, output_file, output_folder,
+            options.get("single_file"), embed_images, center_pages, title, no_bg_color, timings,
+            asset_dir=asset_dir, asset_url=asset_url, optimize_images=optimize_images))
+    finally:
+        shutil.rmtree(temp_output_folder, ignore_errors=True)
+
+
+def stream_from_path(pdf_path, first_chunk_pages=1, max_chunk_pages=16, poppler_path=None, userpw=None, **options):
+    """
+        Converts pdf_path a chunk of pages at a time and yields the single file html as it goes: the head
+        and the first chunk, then the pages of each following chunk as soon as pdftohtml is done with them.
+        Chunks start at first_chunk_pages and double up to max_chunk_pages, so the first page only waits
+        for its own conversion however long the document is. Other options are those of convert_from_path.
+    """
+    page_count = pdfinfo_cached(pdf_path, userpw, poppler_path=poppler_path)["Pages"]
+    options = dict(options, single_file=True)
+    temp_dir = tempfile.mkdtemp()
+    try:
+        first, pages = 1, first_chunk_pages
+        while first <= page_count:
+            last = min(first + pages - 1, page_count)
+            output_file = os.path.join(temp_dir, "%d.html" % first)
+            convert_from_path(pdf_path, output_file=output_file, poppler_path=poppler_path, userpw=userpw,
+                              first_page=first, last_page=last, **options)
+            out = io.StringIO()
+            _append_html_body(output_file, out, first == 1, last == page_count, ("", ""))
+            os.remove(output_file)
+            yield out.getvalue()
+            first, pages = last + 1, min(pages * 2, max_chunk_pages)
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+@contextmanager
+def xml_stream_from_path(pdf_path, poppler_path=None, userpw=None, cpu_limit=None, memory_limit=None):
+    """
+        Runs a text only pdftohtml -xml on pdf_path and yields its standard output, to read each page
+        while pdftohtml is still on the next ones. Raises PDFPopplerError if pdftohtml fails.
+    """
+    args = _build_command([_get_command_path("pdftohtml", poppler_path)], os.path.abspath(pdf_path),
+                          userpw=userpw, xml=True, no_images=True) + ["-stdout"]
+    limits = (cpu_limit, memory_limit)
+    command = _limit_command(args, limits)
+    with tempfile.TemporaryFile() as err_file:
+        process = Popen(command, env=_poppler_env(poppler_path), stdout=PIPE, stderr=err_file)
+        try:
+            _limit_process(process.pid, command, limits)
+            with process.stdout:
+                yield process.stdout
+        except BaseException:
+            process.kill()
+            process.wait()
+            raise
+        process.wait()
+        err_file.seek(0)
+        _check_pdftohtml(process, err_file.read(), False)
+
+
+def _finish_conversion(temp_output_folder, file_name, temp_pdf_path, output_file, output_folder, single_file,
+                       embed_images, center_pages, title, no_bg_color, timings=None, asset_dir=None, asset_url="",
+                       optimize_images=None):
+    """Post-processes the pdftohtml output in temp_output_folder and copies it to its destination"""
     ignore_pattern = "(.+\\.pdf)"
 
     output_html = os.path.join(temp_output_folder, file_name + ".html")
@@ -155,41 +357,394 @@ def convert_from_path(
     if not os.path.exists(output_html):
         output_html = os.path.join(temp_output_folder, file_name + "-html.html")
 
-    if embed_images:
-        ignore_pattern += "|(.+\\.png)|(.+\\.jpg)"
+    images = None
+    links = None
+    if asset_dir or embed_images:
+        ignore_pattern += "|(.+\\.png)|(.+\\.jpg)|(.+\\.webp)"
+        images = {}
         for file in os.listdir(temp_output_folder):
             if file.lower().endswith(".png") or file.lower().endswith(".jpg"):
-                embed_image_into_html(os.path.join(temp_output_folder, file), output_html)
-
+                images[file] = os.path.join(temp_output_folder, file)
+
+        if optimize_images is not None and images:
+            if Image is None:
+                print("optimize_images requires Pillow, images are left as they are")
+            else:
+                with _timed(timings, "optimize_images"):
+                    before = sum(os.path.getsize(path) for path in images.values())
+                    images = _optimize_images(images, **optimize_images)
+                    after = sum(os.path.getsize(path) for path in images.values())
+                if timings is not None:
+                    timings["images_before_bytes"] = before
+                    timings["images_after_bytes"] = after
+
+        if asset_dir:
+            links = {name: asset_url + store_asset(path, asset_dir) for name, path in images.items()}
+            images = None
+
+    substitutions = []
     if center_pages:
-        replace_in_file(output_html, "<head>",
+        substitutions.append(("<head>",
             "<head>"
             "\n<!-- PDF2HTML STYLE START -->\n"
             "<style>body > * {margin: auto;}</style>\n"
-            "<!-- PDF2HTML STYLE END -->")
-
-    if title_from_file_name:
-        title = file_name
+            "<!-- PDF2HTML STYLE END -->"))
 
     if title is not None:
-        replace_in_file(output_html, "<title>{0}</title>".format(output_html), "<title>{0}</title>".format(title))
+        substitutions.append(("<title>{0}</title>".format(output_html), "<title>{0}</title>".format(title)))
 
     if no_bg_color:
-       replace_in_file(output_html, '<body bgcolor="[^"]+"', '<body')
+        substitutions.append(('<body bgcolor="[^"]+"', '<body'))
 
-    if output_file:
-        output_file_dir = os.path.dirname(output_file)
-        copy_tree(temp_output_folder, output_file_dir, ignore_pattern)
-        if single_file:
-            os.rename(os.path.join(output_file_dir, os.path.basename(output_html)), output_file)
+    if images or links or substitutions:
+        with _timed(timings, "postprocess"):
+            rewrite_html(output_html, substitutions, images, links)
 
-    if output_folder:
-        copy_tree(temp_output_folder, output_folder, ignore_pattern)
+    with _timed(timings, "output"):
+        if output_file:
+            output_file_dir = os.path.dirname(output_file)
+            copy_tree(temp_output_folder, output_file_dir, ignore_pattern)
+            if single_file:
+                os.rename(os.path.join(output_file_dir, os.path.basename(output_html)), output_file)
 
-    if temp_pdf_path:
-        os.remove(temp_pdf_path)
+        if output_folder:
+            copy_tree(temp_output_folder, output_folder, ignore_pattern)
 
-    shutil.rmtree(temp_output_folder)
+        if temp_pdf_path:
+            os.remove(temp_pdf_path)
+
+
+@contextmanager
+def _timed(timings, stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if timings is not None:
+            timings[stage] = timings.get(stage, 0) + time.perf_counter() - start
+
+
+def _stage_input(pdf_path, staged_path):
+    """Makes pdf_path available as staged_path, linking it instead of copying whenever possible"""
+    try:
+        os.link(pdf_path, staged_path)
+        return
+    except OSError:
+        pass
+    try:
+        os.symlink(os.path.abspath(pdf_path), staged_path)
+        return
+    except OSError:
+        pass
+    shutil.copyfile(pdf_path, staged_path)
+
+def _run_pdftohtml(args, env, strict, limits=None):
+    """
+        Runs pdftohtml and returns its peak RSS in bytes (None where the platform can't tell).
+        limits is a (cpu seconds, memory bytes) pair, the kernel kills the process when it goes over.
+    """
+    command = _limit_command(args, limits)
+    if not hasattr(os, "wait4"):
+        # Spawn the process and save its uuid
+        process = Popen(command, env=env, stdout=PIPE, stderr=PIPE)
+        _limit_process(process.pid, command, limits)
+
+        data, err = process.communicate()
+
+        _check_pdftohtml(process, err, strict)
+        return None
+
+    # stderr goes through a file so the child can be reaped with wait4, which reports its resource usage
+    with tempfile.TemporaryFile() as err_file:
+        process = Popen(command, env=env, stdout=DEVNULL, stderr=err_file)
+        _limit_process(process.pid, command, limits)
+        _, status, rusage = os.wait4(process.pid, 0)
+        process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+        err_file.seek(0)
+        err = err_file.read()
+
+    _check_pdftohtml(process, err, strict)
+
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    return rusage.ru_maxrss * (1 if platform.system() == "Darwin" else 1024)
+
+
+def _check_pdftohtml(process, err, strict):
+    if process.returncode < 0:
+        # Killed, usually for going over its CPU limit (SIGXCPU) or because the job was cancelled
+        raise PDFPopplerError("pdftohtml was killed by signal %d" % -process.returncode)
+    if err and strict:
+        raise PDFPopplerError()
+
+
+def _limit_command(args, limits):
+    """
+        Prefixes args with the prlimit wrapper when limits are set, so they apply before pdftohtml
+        starts. The wrapper execs pdftohtml, the pid stays the same. Runs in the parent, unlike a
+        preexec_fn, which is not safe to use with the page range threads.
+    """
+    if not limits or not any(limits) or not _prlimit_path():
+        return args
+    cpu_limit, memory_limit = limits
+    wrapper = [_prlimit_path()]
+    if cpu_limit:
+        # The soft limit sends SIGXCPU, the hard one a second later SIGKILL
+        wrapper.append("--cpu=%d:%d" % (int(cpu_limit), int(cpu_limit) + 1))
+    if memory_limit:
+        wrapper.append("--as=%d" % int(memory_limit))
+    return wrapper + ["--"] + args
+
+
+def _limit_process(pid, command, limits):
+    # Without the wrapper, set the limits on the running process instead
+    if not limits or not any(limits) or command[0] == _prlimit_path() or not hasattr(resource, "prlimit"):
+        return
+    cpu_limit, memory_limit = limits
+    try:
+        if cpu_limit:
+            resource.prlimit(pid, resource.RLIMIT_CPU, (int(cpu_limit), int(cpu_limit) + 1))
+        if memory_limit:
+            resource.prlimit(pid, resource.RLIMIT_AS, (int(memory_limit), int(memory_limit)))
+    except ProcessLookupError:
+        # Already done
+        pass
+
+
+@lru_cache(maxsize=None)
+def _prlimit_path():
+    return shutil.which("prlimit")
+
+
+def _split_page_range(first_page, last_page, workers, pages_per_chunk=None):
+    if not pages_per_chunk:
+        pages_per_chunk = -(-(last_page - first_page + 1) // max(workers, 1))
+    return [(start, min(start + pages_per_chunk - 1, last_page))
+            for start in range(first_page, last_page + 1, pages_per_chunk)]
+
+
+def _convert_ranges(build_args, page_ranges, workers, temp_output_folder, file_name, env, strict, limits=None):
+    """
+        Runs one pdftohtml per page range, at most `workers` at a time, and stitches the
+        single file outputs into temp_output_folder/file_name.html in page order.
+        Page div ids, anchors and font classes carry the real page number so they stay unique.
+    """
+    chunk_bases = []
+    for i in range(len(page_ranges)):
+        chunk_dir = os.path.join(temp_output_folder, "chunk%d" % i)
+        os.mkdir(chunk_dir)
+        chunk_bases.append(os.path.join(chunk_dir, file_name))
+
+    # The pool threads only wait on the pdftohtml processes, which do the actual work
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(_run_pdftohtml, build_args(first, last) + [base], env, strict, limits)
+                   for (first, last), base in zip(page_ranges, chunk_bases)]
+        peak_rss = [future.result() for future in futures]
+
+    # pdftohtml falls back to the output base name for the title, keep it as if run in one go
+    title_fix = ("<title>%s</title>" % chunk_bases[0],
+                 "<title>%s</title>" % os.path.join(temp_output_folder, file_name))
+    with open(os.path.join(temp_output_folder, file_name + ".html"), "w", errors="surrogateescape") as out:
+        for i, base in enumerate(chunk_bases):
+            _append_html_body(base + ".html", out, i == 0, i == len(chunk_bases) - 1, title_fix)
+
+    for base in chunk_bases:
+        chunk_dir = os.path.dirname(base)
+        for name in os.listdir(chunk_dir):
+            if not name.endswith(".html"):
+                os.rename(os.path.join(chunk_dir, name), os.path.join(temp_output_folder, name))
+        shutil.rmtree(chunk_dir)
+
+    return max(peak_rss) if None not in peak_rss else None
+
+
+def _append_html_body(html_path, out, with_head, with_tail, title_fix):
+    """
+        Copies the head (with_head), the pages and the end of the body (with_tail) of a single file pdftohtml
+        output to out. pdftohtml puts the whole document outline after the pages of every page range,
+        only the chunk with_tail keeps it.
+    """
+    in_head = with_head
+    in_body = False
+    held = None
+    with open(html_path, "rt", errors="surrogateescape") as f:
+        for line in f:
+            if line.lstrip().startswith("<body"):
+                in_head = False
+                in_body = True
+                if not with_head:
+                    continue
+            if in_head:
+                out.write(line.replace(*title_fix))
+                continue
+            if not in_body:
+                continue
+            if not with_tail:
+                if line.lstrip().startswith('<a name="outline">'):
+                    held = None
+                    break
+                if line.lstrip().startswith("</body>"):
+                    break
+                # The rule pdftohtml writes right before the outline goes with it
+                if held is not None:
+                    out.write(held)
+                    held = None
+                if line.strip() == "<hr/>":
+                    held = line
+                    continue
+            out.write(line)
+    if held is not None:
+        out.write(held)
+
+
+def rewrite_html(html_path, substitutions=(), images=None, links=None):
+    """
+        Applies all post-processing to html_path in a single streaming read/write pass:
+        each (pattern, replacement) substitution runs on every line, then every src="<name>"
+        found in links (name -> url) points to the url and every one found in images
+        (name -> path) is inlined as a base64 data uri. Byte-identical images are encoded once,
+        as a CSS class every <img> showing them uses for its background.
+    """
+    substitutions = [(re.compile(old), new) for old, new in substitutions]
+    shared = _shared_images(images) if images else {}
+    written = set()
+    temp_path = html_path + ".tmp"
+    with open(html_path, "rt", errors="surrogateescape") as fin, \
+            open(temp_path, "wt", errors="surrogateescape") as fout:
+        for line in fin:
+            for pattern, new in substitutions:
+                line = pattern.sub(new, line)
+            if links:
+                line = _SRC_PATTERN.sub(lambda m: 'src="%s"' % links.get(m.group(1), m.group(1)), line)
+            if images:
+                _write_embedding_images(line, images, fout, shared, written)
+            else:
+                fout.write(line)
+    os.replace(temp_path, html_path)
+
+
+_SRC_PATTERN = re.compile('src="([^"]+)"')
+
+# 1x1 transparent gif, the src of images drawn from a shared CSS class
+_BLANK_SRC = "data:image/gif;base64,R0lGODlhAQABAIAAAAAAAP///yH5BAEAAAAALAAAAAABAAEAAAIBRAA7"
+
+# Smaller images are inlined every time, a shared reference would not be shorter
+SHARED_IMAGE_MIN_BYTES = 256
+
+
+def _shared_images(images):
+    """Maps the names of images whose content appears more than once to the CSS class they share"""
+    by_hash = {}
+    for name, path in images.items():
+        if os.path.getsize(path) < SHARED_IMAGE_MIN_BYTES:
+            continue
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                h.update(block)
+        by_hash.setdefault(h.hexdigest(), []).append(name)
+    return {name: "pdf2html-img-" + digest[:16]
+            for digest, names in by_hash.items() if len(names) > 1 for name in names}
+
+
+def _write_embedding_images(line, images, out, shared=None, written=None):
+    matches = [m for m in _SRC_PATTERN.finditer(line) if m.group(1) in images]
+    if shared:
+        for m in matches:
+            name = m.group(1)
+            if name in shared and shared[name] not in written:
+                # Before the line, which may open the <img> tag using it
+                out.write('<style>.%s{background-image:url("' % shared[name])
+                _write_data_uri(images[name], out)
+                out.write('");background-size:100% 100%;}</style>\n')
+                written.add(shared[name])
+    pos = 0
+    for m in matches:
+        name = m.group(1)
+        out.write(line[pos:m.start()])
+        if shared and name in shared:
+            out.write('src="%s" class="%s"' % (_BLANK_SRC, shared[name]))
+        else:
+            out.write('src="')
+            _write_data_uri(images[name], out)
+            out.write('"')
+        pos = m.end()
+    out.write(line[pos:])
+
+
+def _write_data_uri(image_path, out):
+    # The file may have been re-encoded by optimize_images, its own extension gives the type
+    out.write('data:image/{0};base64,'.format(image_path.split(".")[-1]))
+    with open(image_path, 'rb') as f:
+        # Multiples of 3 bytes encode without padding, so the chunks concatenate cleanly
+        for block in iter(lambda: f.read(3 * 256 * 1024), b''):
+            out.write(base64.b64encode(block).decode('utf-8'))
+
+
+# Pillow format -> extension of the re-encoded file
+_IMAGE_EXTENSIONS = {"WEBP": "webp", "JPEG": "jpg", "PNG": "png"}
+
+
+def _optimize_images(images, max_size=None, fmt=None, quality=80, workers=None):
+    """
+        Downscales the images (name -> path) to fit in max_size x max_size pixels and re-encodes them as fmt
+        ("webp", "jpeg", "png" or None to keep their format) next to the originals, one image per thread
+        (Pillow releases the GIL while it decodes, resizes and encodes). Returns name -> path of the smaller
+        of each original and its optimized copy.
+    """
+    names = list(images)
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1) as pool:
+        paths = pool.map(lambda name: _optimize_image(images[name], max_size, fmt, quality), names)
+        return dict(zip(names, paths))
+
+
+def _optimize_image(path, max_size, fmt, quality):
+    try:
+        return _reencode_image(path, max_size, fmt, quality)
+    except Exception as ex:
+        # Not worth failing the conversion for, the original is used instead
+        print("Could not optimize %s: %r" % (path, ex))
+        return path
+
+
+def _reencode_image(path, max_size, fmt, quality):
+    with Image.open(path) as im:
+        fmt = (fmt or im.format or "PNG").upper()
+        alpha = im.mode in ("RGBA", "LA", "PA") or "transparency" in im.info
+        if fmt == "JPEG" and alpha:
+            # JPEG has no alpha channel
+            fmt = "PNG"
+        if fmt not in _IMAGE_EXTENSIONS:
+            return path
+        if fmt == "JPEG" and im.mode not in ("RGB", "L"):
+            im = im.convert("RGB")
+        elif fmt == "WEBP" and im.mode not in ("RGB", "RGBA"):
+            im = im.convert("RGBA" if alpha else "RGB")
+        if max_size and max(im.size) > max_size:
+            im.thumbnail((max_size, max_size), Image.LANCZOS)
+
+        optimized_path = os.path.splitext(path)[0] + "-optimized." + _IMAGE_EXTENSIONS[fmt]
+        if fmt == "PNG":
+            im.save(optimized_path, "PNG", optimize=True)
+        else:
+            im.save(optimized_path, fmt, quality=quality, optimize=True)
+    return optimized_path if os.path.getsize(optimized_path) < os.path.getsize(path) else path
+
+
+def store_asset(path, asset_dir):
+    """Adds the file at path to the content-addressed asset_dir unless it is there already, returns its name"""
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(block)
+    name = h.hexdigest() + os.path.splitext(path)[1].lower()
+    dest = os.path.join(asset_dir, name[:2], name)
+    if not os.path.exists(dest):
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        # Copied under a name of its own first, documents converting in parallel may share the image
+        temp_path = "%s.%d.%d.tmp" % (dest, os.getpid(), threading.get_ident())
+        shutil.copyfile(path, temp_path)
+        os.replace(temp_path, dest)
+    return name
 
 
 def embed_image_into_html(image_path, html_path):
@@ -233,6 +788,7 @@ def convert_from_bytes(
     title_from_file_name=False,
     embed_images=False,
     center_pages=False,
+    no_bg_color=False,
     first_page=None,
     last_page=None,
     dotpdf_to_link=None,
@@ -251,7 +807,15 @@ def convert_from_bytes(
     no_paragraph_merge=None,
     override_drm=None,
     word_break=None,
-    use_font_full_name=None
+    use_font_full_name=None,
+    parallel=None,
+    pages_per_chunk=None,
+    timings=None,
+    cpu_limit=None,
+    memory_limit=None,
+    asset_dir=None,
+    asset_url="",
+    optimize_images=None
 ):
     """
         Description: Convert PDF to Image will throw whenever one of the condition is reached
@@ -268,45 +832,59 @@ def convert_from_bytes(
             poppler_path -> Path to look for poppler binaries
     """
 
-    fh, temp_filename = tempfile.mkstemp()
+    # The bytes are written once, to an anonymous in-memory file where available, and linked from there
+    memfd = hasattr(os, "memfd_create") and os.path.isdir("/proc/%d/fd" % os.getpid())
+    if memfd:
+        fh = os.memfd_create("pdf2html")
+        temp_filename = "/proc/%d/fd/%d" % (os.getpid(), fh)
+    else:
+        fh, temp_filename = tempfile.mkstemp()
     try:
-        with open(temp_filename, "wb") as f:
+        with open(fh, "wb", closefd=False) as f:
             f.write(pdf_file)
-            f.flush()
-            return convert_from_path(
-                f.name,
-                output_folder,
-                output_file,
-                poppler_path,
-                strict,
-                title,
-                title_from_file_name,
-                embed_images,
-                center_pages,
-                first_page,
-                last_page,
-                dotpdf_to_link,
-                complex_styles,
-                single_file,
-                no_images,
-                no_frames,
-                zoom,
-                xml,
-                no_coord_rounding,
-                output_encoding,
-                ownerpw,
-                userpw,
-                include_hidden,
-                image_fmt,
-                no_paragraph_merge,
-                override_drm,
-                word_break,
-                use_font_full_name
-            )
+        return convert_from_path(
+            temp_filename,
+            output_folder=output_folder,
+            output_file=output_file,
+            poppler_path=poppler_path,
+            strict=strict,
+            title=title,
+            title_from_file_name=title_from_file_name,
+            embed_images=embed_images,
+            center_pages=center_pages,
+            no_bg_color=no_bg_color,
+            first_page=first_page,
+            last_page=last_page,
+            dotpdf_to_link=dotpdf_to_link,
+            complex_styles=complex_styles,
+            single_file=single_file,
+            no_images=no_images,
+            no_frames=no_frames,
+            zoom=zoom,
+            xml=xml,
+            no_coord_rounding=no_coord_rounding,
+            output_encoding=output_encoding,
+            ownerpw=ownerpw,
+            userpw=userpw,
+            include_hidden=include_hidden,
+            image_fmt=image_fmt,
+            no_paragraph_merge=no_paragraph_merge,
+            override_drm=override_drm,
+            word_break=word_break,
+            use_font_full_name=use_font_full_name,
+            parallel=parallel,
+            pages_per_chunk=pages_per_chunk,
+            timings=timings,
+            cpu_limit=cpu_limit,
+            memory_limit=memory_limit,
+            asset_dir=asset_dir,
+            asset_url=asset_url,
+            optimize_images=optimize_images
+        )
     finally:
         os.close(fh)
-        os.remove(temp_filename)
-
+        if not memfd:
+            os.remove(temp_filename)
 
 def _build_command(
     args,
@@ -406,6 +984,7 @@ def _get_command_path(command, poppler_path=None):
     return command
 
 
+@lru_cache(maxsize=None)
 def _get_poppler_version(command, poppler_path=None):
     command = [_get_command_path(command, poppler_path), "-v"]
 
@@ -426,46 +1005,112 @@ def _get_poppler_version(command, poppler_path=None):
         return 17
 
 
-def pdfinfo_from_path(pdf_path, userpw=None, poppler_path=None):
+@lru_cache(maxsize=None)
+def get_poppler_version(poppler_path=None):
+    """Full version string of the pdftohtml binary (e.g. 22.02.0), None if it can't be determined"""
+    command = [_get_command_path("pdftohtml", poppler_path), "-v"]
+
+    env = os.environ.copy()
+    if poppler_path is not None:
+        env["LD_LIBRARY_PATH"] = poppler_path + ":" + env.get("LD_LIBRARY_PATH", "")
     try:
-        command = [_get_command_path("pdfinfo", poppler_path), pdf_path]
+        proc = Popen(command, env=env, stdout=PIPE, stderr=PIPE)
+    except OSError:
+        return None
 
-        if userpw is not None:
-            command.extend(["-upw", userpw])
+    out, err = proc.communicate()
 
-        # Add poppler path to LD_LIBRARY_PATH
-        env = os.environ.copy()
-        if poppler_path is not None:
-            env["LD_LIBRARY_PATH"] = poppler_path + ":" + env.get("LD_LIBRARY_PATH", "")
-        proc = Popen(command, env=env, stdout=PIPE, stderr=PIPE)
+    m = re.search("version ([0-9][0-9.]*)", (out + err).decode("utf8", "ignore"))
+    return m.group(1) if m else None
 
-        out, err = proc.communicate()
 
-        d = {}
-        for field in out.decode("utf8", "ignore").split("\n"):
-            sf = field.split(":")
-            key, value = sf[0], ":".join(sf[1:])
-            if key != "":
-                d[key] = (
-                    int(value.strip())
-                    if key in PDFINFO_CONVERT_TO_INT
-                    else value.strip()
-                )
+def pdfinfo_from_path(pdf_path, userpw=None, poppler_path=None):
+    try:
+        proc = Popen(_pdfinfo_command(pdf_path, userpw, poppler_path), env=_poppler_env(poppler_path),
+                     stdout=PIPE, stderr=PIPE)
+    except OSError:
+        raise PDFInfoNotInstalledError(
+            "Unable to get page count. Is poppler installed and in PATH?"
+        )
 
-        if "Pages" not in d:
-            raise ValueError
+    out, err = proc.communicate()
+    return _parse_pdfinfo(out, err)
 
-        return d
 
+async def pdfinfo_from_path_async(pdf_path, userpw=None, poppler_path=None):
+    """pdfinfo_from_path for asyncio, the event loop keeps serving while pdfinfo runs"""
+    try:
+        proc = await asyncio.create_subprocess_exec(*_pdfinfo_command(pdf_path, userpw, poppler_path),
+                                                    env=_poppler_env(poppler_path), stdout=PIPE, stderr=PIPE)
     except OSError:
         raise PDFInfoNotInstalledError(
             "Unable to get page count. Is poppler installed and in PATH?"
         )
-    except ValueError:
+
+    out, err = await proc.communicate()
+    return _parse_pdfinfo(out, err)
+
+
+def _pdfinfo_command(pdf_path, userpw=None, poppler_path=None):
+    command = [_get_command_path("pdfinfo", poppler_path), pdf_path]
+
+    if userpw is not None:
+        command.extend(["-upw", userpw])
+
+    return command
+
+
+def _parse_pdfinfo(out, err):
+    d = {}
+    for field in out.decode("utf8", "ignore").split("\n"):
+        sf = field.split(":")
+        key, value = sf[0], ":".join(sf[1:])
+        if key != "":
+            try:
+                d[key] = (
+                    int(value.strip())
+                    if key in PDFINFO_CONVERT_TO_INT
+                    else value.strip()
+                )
+            except ValueError:
+                break
+
+    if "Pages" not in d:
         raise PDFPageCountError(
             "Unable to get page count.\n%s" % err.decode("utf8", "ignore")
         )
 
+    return d
+
+
+def _poppler_env(poppler_path=None):
+    # Add poppler path to LD_LIBRARY_PATH
+    env = os.environ.copy()
+    if poppler_path is not None:
+        env["LD_LIBRARY_PATH"] = poppler_path + ":" + env.get("LD_LIBRARY_PATH", "")
+    return env
+
+
+def pdfinfo_cached(pdf_path, userpw=None, poppler_path=None):
+    """
+        pdfinfo_from_path memoized on the file identity (device, inode, size, mtime),
+        so an unchanged file only spawns pdfinfo once per process
+    """
+    st = os.stat(pdf_path)
+    key = (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, userpw, poppler_path)
+    with _pdfinfo_cache_lock:
+        if key in _pdfinfo_cache:
+            _pdfinfo_cache.move_to_end(key)
+            return dict(_pdfinfo_cache[key])
+
+    info = pdfinfo_from_path(pdf_path, userpw, poppler_path)
+
+    with _pdfinfo_cache_lock:
+        _pdfinfo_cache[key] = info
+        if len(_pdfinfo_cache) > PDFINFO_CACHE_SIZE:
+            _pdfinfo_cache.popitem(last=False)
+    return dict(info)
+
 
 def pdfinfo_from_bytes(pdf_file):
     fh, temp_filename = tempfile.mkstemp()
@@ -0,0 +1,57 @@
+import re
+import numpy as np
+
+# Class added to the paragraphs found repeated, h# tag detection skips them
+REPEATED_CLASS = "pdf2html-repeated"
+
+# A box is repeated when it is on at least this share of the pages, and on no fewer than MIN_PAGES
+MIN_PAGE_SHARE = 0.5
+MIN_PAGES = 3
+
+# Pixels two boxes may be apart and still be at the same position
+POSITION_TOLERANCE = 4
+
+_DIGITS = re.compile("[0-9]+")
+
+
+def find_repeated(pages, tops, lefts, texts):
+    """
+        Running headers, footers and page numbers: boxes with the same text (numbers aside) at the same
+        position on many pages. Takes one entry per box in each list and returns a numpy mask over the boxes.
+        Boxes are grouped by (text, position) and their pages counted with numpy sorts, not compared pairwise.
+        Positions are clustered on the sorted values, so boxes a few pixels apart group together however
+        they fall relative to each other.
+    """
+    if not texts:
+        return np.zeros(0, dtype=bool)
+
+    page_ids = np.unique(np.array(pages, dtype=object), return_inverse=True)[1].reshape(-1)
+    page_count = int(page_ids.max()) + 1
+    threshold = max(MIN_PAGES, int(np.ceil(MIN_PAGE_SHARE * page_count)))
+    if page_count < threshold:
+        return np.zeros(len(texts), dtype=bool)
+
+    text_ids = {}
+    texts = np.array([text_ids.setdefault(_DIGITS.sub("#", " ".join(text.split()).lower()), len(text_ids))
+                      for text in texts], dtype=np.int64)
+    rows = _cluster(texts, np.array(tops, dtype=float))
+    groups = _cluster(rows, np.array(lefts, dtype=float))
+
+    # Pages each (text, position) group shows up on, a box repeated within a page counts once
+    group_pages = np.unique(np.stack([groups, page_ids], axis=1), axis=0)
+    pages_per_group = np.bincount(group_pages[:, 0], minlength=int(groups.max()) + 1)
+    return pages_per_group[groups] >= threshold
+
+
+def _cluster(labels, values):
+    """
+        Cluster ids of values within each label: sorted, a value more than POSITION_TOLERANCE past the
+        previous one starts a new cluster. Ids are unique across labels.
+    """
+    order = np.lexsort((values, labels))
+    labels, values = labels[order], values[order]
+    starts = np.ones(len(order), dtype=bool)
+    starts[1:] = (labels[1:] != labels[:-1]) | (np.diff(values) > POSITION_TOLERANCE)
+    ids = np.empty(len(order), dtype=np.int64)
+    ids[order] = np.cumsum(starts) - 1
+    return ids
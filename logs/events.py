@@ -0,0 +1,61 @@
+import os
+import json
+import time
+from datetime import datetime
+
+
+def write_event(f, event, message="", **fields):
+    """Appends one event record to f, an open binary append handle"""
+    record = dict(fields, ts=datetime.now().strftime("%m/%d/%Y, %H:%M:%S"), event=event, message=message)
+    # A single write per record keeps concurrent appends whole
+    f.write((json.dumps(record) + "\n").encode("utf8"))
+    f.flush()
+
+
+def append_event(logf, event, message="", **fields):
+    with open(logf, 'ab') as f:
+        write_event(f, event, message, **fields)
+
+
+def read_events(logf, offset=0):
+    """
+        Events recorded after byte offset, each with its own "offset" and the "next" one to read from.
+        Returns the events and the offset to resume from.
+    """
+    events = []
+    if not os.path.exists(logf):
+        return events, offset
+    with open(logf, 'rb') as f:
+        f.seek(offset)
+        for line in f:
+            if not line.endswith(b"\n"):
+                # Still being written
+                break
+            event = json.loads(line.decode("utf8"))
+            event["offset"] = offset
+            offset += len(line)
+            event["next"] = offset
+            events.append(event)
+    return events, offset
+
+
+def tail_events(logf, offset=0, poll_interval=0.5, heartbeat=15):
+    """
+        Yields events as they are appended, starting at offset, until the "done" event.
+        Yields None every `heartbeat` seconds without events so callers can detect dropped clients.
+    """
+    idle = 0
+    while True:
+        if os.path.exists(logf) and os.path.getsize(logf) > offset:
+            events, offset = read_events(logf, offset)
+            for event in events:
+                yield event
+                if event["event"] == "done":
+                    return
+            idle = 0
+            continue
+        time.sleep(poll_interval)
+        idle += poll_interval
+        if idle >= heartbeat:
+            idle = 0
+            yield None
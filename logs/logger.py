@@ -1,29 +1,55 @@
 import os
-from flask import Response, flash, redirect
+import json
+from flask import Response, flash, redirect, jsonify
+from logs.events import read_events, tail_events
 
 
-def yield_log(logf, redirect_to):
+def format_event(event):
+    return "[%s] %s" % (event["ts"], event["message"].replace("\n", "</br>"))
+
+
+def yield_log(logf, redirect_to, stream_url, queue_position=0):
     if os.path.exists(logf):
         def generate():
-            with open(logf, 'r') as f:
-                lines = f.readlines()
+            events, offset = read_events(logf)
+            done = bool(events) and events[-1]["event"] == "done"
             yield "<html>"
-            if lines and not lines[-1].endswith("DONE!"):
+            if queue_position:
+                yield "<center id='queue-position'>Waiting for a worker, position %d in queue.</center><br>" \
+                      % queue_position
+            if not done:
                 yield """
-                        <center>
+                        <center id="log-pending">
                         Process not done yet!
-                        This page will automatically refresh in 5 seconds...<br>
+                        This page updates automatically...<br>
                         <img src="/img/loading.gif"></img>
                         </center>
+                      """
+            yield "<div id='log-lines'>"
+            for event in reversed(events):
+                yield format_event(event) + "</br>"
+            yield "</div>"
+            if not done:
+                yield """
                         <script>
-                        setTimeout(function() {
-                          location.reload();
-                        }, 5000);
+                        var source = new EventSource("%s?offset=%d");
+                        source.onmessage = function(e) {
+                          var ev = JSON.parse(e.data);
+                          var line = document.createElement("span");
+                          line.innerHTML = "[" + ev.ts + "] " + ev.message.split("\\n").join("</br>") + "</br>";
+                          var lines = document.getElementById("log-lines");
+                          lines.insertBefore(line, lines.firstChild);
+                          var position = document.getElementById("queue-position");
+                          if (ev.event == "started" && position) {
+                            position.style.display = "none";
+                          }
+                          if (ev.event == "done") {
+                            source.close();
+                            document.getElementById("log-pending").style.display = "none";
+                          }
+                        };
                         </script>
-                      """
-            line = ""
-            for line in reversed(lines):
-                yield line + "</br>"
+                      """ % (stream_url, offset)
             yield "</html>"
 
         return Response(generate(), mimetype='text/html')
@@ -31,8 +57,30 @@ def yield_log(logf, redirect_to):
     return redirect(redirect_to)
 
 
+def log_events(logf, offset, queue_position=0):
+    events, offset = read_events(logf, offset)
+    return jsonify({
+        "events": events,
+        "offset": offset,
+        "done": any(e["event"] == "done" for e in events),
+        "queue_position": queue_position
+    })
+
+
+def stream_log(logf, offset):
+    def generate():
+        for event in tail_events(logf, offset):
+            if event is None:
+                yield ": keep-alive\n\n"
+            else:
+                # Browsers resend the id as Last-Event-ID when they reconnect
+                yield "id: %d\ndata: %s\n\n" % (event["next"], json.dumps(event))
+
+    return Response(generate(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+
 def clear_log(logf, redirect_to):
     if os.path.exists(logf):
         os.remove(logf)
     flash('Log cleared.')
-    return redirect(redirect_to)
\ No newline at end of file
+    return redirect(redirect_to)
@@ -0,0 +1,90 @@
+import os
+import json
+from config.processing import METRICS_FILE
+from helpers.functions import mkdir_p, locked_json
+
+DURATION_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+BYTES_BUCKETS = tuple(2 ** n for n in range(20, 34, 2))
+
+HELP = {
+    "pdf2html_stage_duration_seconds": ("histogram", "Time spent per conversion stage"),
+    "pdf2html_job_duration_seconds": ("histogram", "Time from a worker picking a job up to its end"),
+    "pdf2html_pdftohtml_peak_rss_bytes": ("histogram", "Peak resident memory of the pdftohtml processes of a document"),
+    "pdf2html_jobs_started_total": ("counter", "Jobs picked up by a worker"),
+    "pdf2html_jobs_succeeded_total": ("counter", "Jobs that finished without an error"),
+    "pdf2html_jobs_failed_total": ("counter", "Jobs that raised an error"),
+    "pdf2html_jobs_killed_total": ("counter", "Jobs killed by reason (timeout or cancelled)"),
+    "pdf2html_jobs_coalesced_total": ("counter", "Requests that followed a pending job for the same input and options"),
+    "pdf2html_documents_total": ("counter", "PDF documents converted, by source (pdftohtml or cache)"),
+    "pdf2html_input_bytes_total": ("counter", "PDF bytes converted"),
+    "pdf2html_output_bytes_total": ("counter", "HTML bytes written"),
+    "pdf2html_jobs_in_flight": ("gauge", "Jobs currently running on a worker"),
+    "pdf2html_jobs_queued": ("gauge", "Jobs waiting for a worker"),
+}
+
+
+def inc(name, value=1, **labels):
+    with _locked_metrics() as metrics:
+        key = _key(name, labels)
+        metrics["counters"][key] = metrics["counters"].get(key, 0) + value
+
+
+def observe(name, value, buckets=DURATION_BUCKETS, **labels):
+    observe_many([(name, value, buckets, labels)])
+
+
+def observe_many(observations):
+    """Records (name, value, buckets, labels) histogram observations under a single lock"""
+    with _locked_metrics() as metrics:
+        for name, value, buckets, labels in observations:
+            key = _key(name, labels)
+            h = metrics["histograms"].setdefault(key, {"buckets": list(buckets), "counts": [0] * len(buckets),
+                                                       "sum": 0, "count": 0})
+            for i, bound in enumerate(h["buckets"]):
+                if value <= bound:
+                    h["counts"][i] += 1
+            h["sum"] += value
+            h["count"] += 1
+
+
+def render(gauges=None):
+    """Prometheus text exposition of everything recorded plus the live `gauges` ({name: value})"""
+    with _locked_metrics(write=False) as metrics:
+        pass
+    samples = {}
+    for key, value in metrics["counters"].items():
+        name, labels = json.loads(key)
+        samples.setdefault(name, []).append(_sample(name, labels, value))
+    for key, h in metrics["histograms"].items():
+        name, labels = json.loads(key)
+        for bound, count in zip(h["buckets"], h["counts"]):
+            samples.setdefault(name, []).append(_sample(name + "_bucket", dict(labels, le=repr(float(bound))), count))
+        samples[name].append(_sample(name + "_bucket", dict(labels, le="+Inf"), h["count"]))
+        samples[name].append(_sample(name + "_sum", labels, h["sum"]))
+        samples[name].append(_sample(name + "_count", labels, h["count"]))
+    for name, value in (gauges or {}).items():
+        samples.setdefault(name, []).append(_sample(name, {}, value))
+
+    lines = []
+    for name in sorted(samples):
+        kind, text = HELP.get(name, ("untyped", name))
+        lines.append("# HELP %s %s" % (name, text))
+        lines.append("# TYPE %s %s" % (name, kind))
+        lines.extend(samples[name])
+    return "\n".join(lines) + "\n"
+
+
+def _key(name, labels):
+    return json.dumps([name, labels], sort_keys=True)
+
+
+def _sample(name, labels, value):
+    if labels:
+        name += "{%s}" % ",".join('%s="%s"' % (k, str(v).replace('"', '\\"')) for k, v in sorted(labels.items()))
+    return "%s %s" % (name, repr(float(value)) if isinstance(value, float) else value)
+
+
+def _locked_metrics(write=True):
+    # Metrics live in a file since they are recorded from the worker processes
+    mkdir_p(os.path.dirname(METRICS_FILE))
+    return locked_json(METRICS_FILE, {"counters": {}, "histograms": {}}, write)
@@ -1,52 +1,305 @@
-from multiprocessing import Process
+import multiprocessing
+import atexit
 from config.environment import DEBUGGING
-from datetime import datetime
+from config.processing import JOB_WORKERS, JOB_QUEUE_SIZE, JOB_TIMEOUT, JOB_KILL_GRACE
+from logs.events import append_event, write_event
+from metrics import collector as metrics
+from queue import Empty
+import threading
+import signal
+import sys
+import time
 import traceback
+import tempfile
+import shutil
+import json
 import os
 
+_pool = None
+_pool_lock = threading.Lock()
 
-def start_processing(do_work, logf):
+
+class QueueFullError(Exception):
+    """Happens when JOB_QUEUE_SIZE jobs are already waiting for a worker"""
+
+    pass
+
+
+def job_key(path, options=None):
+    """Identifies a conversion by its input file, as it is on disk now, and its options"""
+    st = os.stat(path)
+    return json.dumps([os.path.abspath(path), st.st_size, st.st_mtime_ns, options or {}], sort_keys=True)
+
+
+def pending_job(key):
+    """Log of the queued or running job started with key, None when there is none"""
+    if _pool is None:
+        return None
+    with _pool_lock:
+        _reap_finished()
+        if key not in _pool['pending'] or _pool['pending'][key][1] not in _pool['unfinished']:
+            return None
+        return _pool['pending'][key][0]
+
+
+def _reap_finished():
+    # The workers send the number of every job they are done with, whichever way it ended, see _worker_loop.
+    # Unlike the log, shared by the jobs of a file and cleared at will, the number belongs to a single job.
+    while True:
+        try:
+            _pool['unfinished'].discard(_pool['finished_jobs'].get_nowait())
+        except Empty:
+            break
+
+
+def queue_full():
+    """Whether start_processing would raise QueueFullError for a new job right now"""
+    return _pool is not None and _pool['submitted'] - _pool['dispatched'].value >= JOB_QUEUE_SIZE
+
+
+def start_processing(process_file, proc_args, prefix, logf, key=None, on_failure=None):
+    """
+        Queues the job and returns the log it writes to. When key is given and a job started with the same
+        key is still queued or running, nothing is queued and the log of that job is returned instead.
+        on_failure is called with proc_args, like process_file, once the job failed, was cancelled or timed out.
+    """
     if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
         return "DEBUG"
     else:
-        with open(logf, 'a+', errors="surrogateescape") as f:
-            ts = datetime.now().strftime("%m/%d/%Y, %H:%M:%S")
-            f.write("\n[%s] Started Processing.\n" %ts)
-            if DEBUGGING:
-                f.write("\n[%s] DEBUG MODE ENABLED\n" % ts)
-
         if DEBUGGING:
-            do_work()
-        else:
-            p = Process(target=do_work)
+            append_event(logf, "debug", "DEBUG MODE ENABLED")
+            create_worker(process_file, proc_args, prefix, logf, on_failure)()
+            return logf
+
+        with _pool_lock:
+            pool = _get_pool()
+            _reap_finished()
+            if key is not None:
+                for k, (pending_logf, pending_number) in list(pool['pending'].items()):
+                    if pending_number not in pool['unfinished']:
+                        del pool['pending'][k]
+                if key in pool['pending']:
+                    metrics.inc("pdf2html_jobs_coalesced_total")
+                    return pool['pending'][key][0]
+
+            position = pool['submitted'] - pool['dispatched'].value + 1
+            if position > JOB_QUEUE_SIZE:
+                raise QueueFullError("%d jobs are already waiting" % JOB_QUEUE_SIZE)
+            pool['submitted'] += 1
+            number = pool['jobs'][logf] = pool['submitted']
+            pool['unfinished'].add(number)
+            # Numbers start over with the process, a marker a killed supervisor left behind is not for this job
+            if os.path.exists(_cancel_marker(logf, number)):
+                os.remove(_cancel_marker(logf, number))
+            append_event(logf, "queued", "Queued at position %d." % position, position=position)
+            pool['queue'].put((process_file, proc_args, prefix, logf, number, on_failure))
+            if key is not None:
+                pool['pending'][key] = (logf, number)
+            return logf
+
+
+def cancel_processing(logf):
+    """
+        Asks the worker running (or about to run) the job logging to logf to kill it.
+        Returns False when no job is pending for logf.
+    """
+    if _pool is None:
+        return False
+    with _pool_lock:
+        _reap_finished()
+        number = _pool['jobs'].get(logf)
+        if number not in _pool['unfinished']:
+            return False
+    # The job runs in another process, the marker next to its log is how it finds out. It carries the
+    # job's number, so a job queued later for the same log neither sees it nor clears it.
+    open(_cancel_marker(logf, number), 'w').close()
+    return True
+
+
+def _cancel_marker(logf, number):
+    return "%s.%d.cancel" % (logf, number)
+
+
+def queue_position(logf):
+    """Jobs ahead of (and including) the one logging to logf, 0 once it was picked by a worker"""
+    if _pool is None or logf not in _pool['jobs']:
+        return 0
+    return max(_pool['jobs'][logf] - _pool['dispatched'].value, 0)
+
+
+def pool_gauges():
+    """Live queue gauges for the metrics endpoint"""
+    if _pool is None:
+        return {"pdf2html_jobs_queued": 0, "pdf2html_jobs_in_flight": 0}
+    dispatched = _pool['dispatched'].value
+    return {
+        "pdf2html_jobs_queued": _pool['submitted'] - dispatched,
+        "pdf2html_jobs_in_flight": dispatched - _pool['finished'].value
+    }
+
+
+def _get_pool():
+    global _pool
+    if _pool is None:
+        queue = multiprocessing.Queue()
+        dispatched = multiprocessing.Value('i', 0)
+        finished = multiprocessing.Value('i', 0)
+        finished_jobs = multiprocessing.Queue()
+        for i in range(JOB_WORKERS):
+            # Not daemonic, so jobs can use process pools of their own
+            p = multiprocessing.Process(target=_worker_loop,
+                                        args=(queue, dispatched, finished, finished_jobs, os.getpid()))
             p.start()
+        atexit.register(_stop_workers, queue)
+        # jobs maps every log to the number of the latest job writing to it, unfinished holds the numbers of the
+        # queued and running jobs and pending maps the key of every job started with one to its log and number
+        _pool = {'queue': queue, 'dispatched': dispatched, 'finished': finished, 'finished_jobs': finished_jobs,
+                 'submitted': 0, 'jobs': {}, 'unfinished': set(), 'pending': {}}
+    return _pool
 
 
-def create_worker(process_file, proc_args, prefix, logf):
-    def do_work():
+def _stop_workers(queue):
+    # Workers finish their current job and exit on the sentinel
+    for i in range(JOB_WORKERS):
+        queue.put(None)
+
+
+def _worker_loop(queue, dispatched, finished, finished_jobs, parent):
+    while True:
+        try:
+            job = queue.get(timeout=1)
+        except Empty:
+            # The app died without sending the sentinels (killed, os._exit), nothing would ever stop this worker
+            if os.getppid() != parent:
+                break
+            continue
+        if job is None:
+            break
+        process_file, proc_args, prefix, logf, number, on_failure = job
+        with dispatched.get_lock():
+            dispatched.value += 1
+        try:
+            _supervise(process_file, proc_args, prefix, logf, number, on_failure)
+        finally:
+            with finished.get_lock():
+                finished.value += 1
+            finished_jobs.put(number)
+
+
+def _supervise(process_file, proc_args, prefix, logf, number, on_failure=None):
+    """
+        Runs the job in a process group of its own and kills the whole group (the job, its pdftohtml
+        processes and any process pool) once it is cancelled or goes past JOB_TIMEOUT.
+        The job's temp files all go to a directory of its own, removed here whichever way it ended.
+    """
+    if os.path.exists(_cancel_marker(logf, number)):
+        os.remove(_cancel_marker(logf, number))
+        append_event(logf, "cancelled", "Cancelled before it started.", reason="cancelled")
+        append_event(logf, "done", "DONE!", success=False)
+        _failed(on_failure, proc_args)
+        return
+
+    temp_dir = tempfile.mkdtemp(prefix="pdf2html-job-")
+    job = multiprocessing.Process(target=_run_job,
+                                  args=(process_file, proc_args, prefix, logf, temp_dir, on_failure))
+    job.start()
+    deadline = time.monotonic() + JOB_TIMEOUT if JOB_TIMEOUT else None
+    reason = None
+    while reason is None:
+        job.join(0.5)
+        if job.exitcode is not None:
+            break
+        if os.path.exists(_cancel_marker(logf, number)):
+            reason = "cancelled"
+        elif deadline is not None and time.monotonic() > deadline:
+            reason = "timeout"
+
+    if reason is not None:
+        _kill_group(job)
+        metrics.inc("pdf2html_jobs_killed_total", reason=reason)
+        metrics.inc("pdf2html_jobs_failed_total")
+        if reason == "timeout":
+            message = "Killed after running for more than %d seconds." % JOB_TIMEOUT
+        else:
+            message = "Cancelled."
+        append_event(logf, "cancelled", message, reason=reason)
+        append_event(logf, "done", "DONE!", success=False)
+        _failed(on_failure, proc_args)
+    elif job.exitcode != 0:
+        # Died without reporting back, e.g. killed by the OOM killer
+        append_event(logf, "exception", "[EXCEPTION] Job process exited with code %d" % job.exitcode)
+        append_event(logf, "done", "DONE!", success=False)
+        _failed(on_failure, proc_args)
+
+    shutil.rmtree(temp_dir, ignore_errors=True)
+    if os.path.exists(_cancel_marker(logf, number)):
+        os.remove(_cancel_marker(logf, number))
+
+
+def _kill_group(job):
+    # SIGTERM first so the job unwinds and removes its temp dirs, then SIGKILL whatever is left of the group
+    _signal_group(job.pid, signal.SIGTERM)
+    job.join(JOB_KILL_GRACE)
+    _signal_group(job.pid, signal.SIGKILL)
+    job.join()
+
+
+def _signal_group(pgid, sig):
+    try:
+        os.killpg(pgid, sig)
+    except ProcessLookupError:
+        # Not a group leader yet, or gone already
         try:
-            for line in process_file(*proc_args):
-                with open(logf, 'a+', errors="surrogateescape") as f:
-                    ts = datetime.now().strftime("%m/%d/%Y, %H:%M:%S")
-                    f.write("[%s] %s\n" % (ts, line));
-
-            success = True
-        except Exception as ex:
-            success = False
-            with open(logf, 'a+') as f:
-                ts = datetime.now().strftime("%m/%d/%Y, %H:%M:%S")
-                f.write("[%s][EXCEPTION]" % ts)
-                f.write(repr(ex))
-                traceback.print_exc(None, f)
+            os.kill(pgid, sig)
+        except ProcessLookupError:
+            pass
+
+
+def _failed(on_failure, proc_args):
+    if on_failure is None:
+        return
+    try:
+        on_failure(*proc_args)
+    except Exception:
+        traceback.print_exc()
+
+
+def _run_job(process_file, proc_args, prefix, logf, temp_dir, on_failure=None):
+    os.setsid()
+    # Inherited by pdftohtml and pool processes too
+    os.environ["TMPDIR"] = tempfile.tempdir = temp_dir
+    # Raising unwinds the job, so finally blocks and context managers clean up after it
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+    create_worker(process_file, proc_args, prefix, logf, on_failure)()
+
+
+def create_worker(process_file, proc_args, prefix, logf, on_failure=None):
+    def do_work():
+        start = time.perf_counter()
+        metrics.inc("pdf2html_jobs_started_total")
+        with open(logf, 'ab') as log:
+            write_event(log, "started", "Started Processing.")
+            try:
+                for line in process_file(*proc_args):
+                    write_event(log, "progress", line)
+
+                success = True
+            except Exception as ex:
+                success = False
+                write_event(log, "exception", "[EXCEPTION]" + repr(ex) + "\n" + traceback.format_exc())
                 traceback.print_exc()
 
-        ts = datetime.now().strftime("%m/%d/%Y, %H:%M:%S")
-        with open(logf, 'a+') as f:
             if success:
-                f.write("[%s] Files should appear in <a href='%s'>View Files</a><br>" % (ts, "/%s/proc/view" % prefix))
+                write_event(log, "result", "Files should appear in <a href='%s'>View Files</a>" % ("/%s/proc/view" % prefix))
             else:
-                f.write("[%s] !!!!!!!!!!!! Operation Failed !!!!!!!!!!!!!!!" % ts)
+                write_event(log, "result", "!!!!!!!!!!!! Operation Failed !!!!!!!!!!!!!!!")
+
+            write_event(log, "done", "DONE!", success=success)
+
+        if not success:
+            _failed(on_failure, proc_args)
 
-            f.write("[%s] DONE!" % ts)
+        metrics.inc("pdf2html_jobs_succeeded_total" if success else "pdf2html_jobs_failed_total")
+        metrics.observe("pdf2html_job_duration_seconds", time.perf_counter() - start)
 
     return do_work
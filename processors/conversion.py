@@ -1,67 +1,449 @@
 #!/usr/bin/env python
 # coding: utf-8
 
-from helpers.pdf2html import convert_from_path
+from helpers.pdf2html import convert_from_path, convert_from_path_async, stream_from_path, xml_stream_from_path, \
+    get_poppler_version
+from config.conversion import PAGE_WORKERS, BATCH_WORKERS, CACHE_MAX_BYTES, TAG_ENGINE, \
+    PDFTOHTML_CPU_SECONDS, PDFTOHTML_MEMORY_BYTES, IMAGE_MODE, ASSET_DIR, ASSET_URL, \
+    IMAGE_OPTIMIZE, IMAGE_MAX_SIZE, IMAGE_FORMAT, IMAGE_QUALITY, STREAM_WORKERS, STREAM_MAX_CHUNK_PAGES, \
+    PAGE_RECORDS, STRIP_REPEATED, PREVIEW_PAGES, PREVIEW_WORKERS
+from cache import manager as cache
+from compression import manager as compression
+from catalog import manager as catalog
+from helpers.functions import mkdir_p
+from metrics import collector as metrics
+from layout.manager import find_repeated, REPEATED_CLASS
 import os
+import json
+import asyncio
 import tempfile
-from shutil import rmtree
+import threading
+import time
+from shutil import rmtree, copyfileobj
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 from zipfile import ZipFile
+from contextlib import contextmanager, nullcontext
+from functools import partial
 from bs4 import BeautifulSoup
+from html.parser import HTMLParser
+from html import escape
+from xml.etree import ElementTree
 import re
 
 
-def process_file(fname, dest_dir):
+CONVERSION_OPTIONS = {
+    "single_file": True,
+    # "complex_styles": True,
+    "embed_images": True,
+    "no_frames": True,
+    # "no_images": True,
+    "center_pages": True,
+    "no_bg_color": True,
+    # "title_from_file_name": True
+}
+
+
+# CONVERSION_OPTIONS a request may change
+REQUEST_OPTIONS = ("center_pages", "no_bg_color", "no_images")
+
+# Start of every preview's body, the full conversion may overwrite a file starting with it
+PREVIEW_MARKER = "<!-- PDF2HTML PREVIEW -->"
+
+
+def conversion_options(overrides=None):
+    """CONVERSION_OPTIONS with the REQUEST_OPTIONS in overrides, for the configured IMAGE_MODE and image optimization"""
+    options = dict(CONVERSION_OPTIONS)
+    options.update((k, v) for k, v in (overrides or {}).items() if k in REQUEST_OPTIONS)
+    if IMAGE_MODE == "assets":
+        options.update(embed_images=False, asset_dir=ASSET_DIR, asset_url=ASSET_URL)
+    if IMAGE_OPTIMIZE:
+        options["optimize_images"] = {"max_size": IMAGE_MAX_SIZE, "fmt": IMAGE_FORMAT or None,
+                                      "quality": IMAGE_QUALITY}
+    return options
+
+
+def cache_options(overrides=None):
+    """Everything the converted html depends on besides the pdf and poppler"""
+    return dict(conversion_options(overrides), tag_engine=TAG_ENGINE, strip_repeated=STRIP_REPEATED)
+
+
+def output_name(fname):
+    return '.'.join(os.path.splitext(os.path.split(fname)[-1])[:-1])
+
+
+def process_file(fname, dest_dir, cache_dir=None, options=None):
     ext = os.path.splitext(fname)[-1]
-    file_name = '.'.join(os.path.splitext(os.path.split(fname)[-1])[:-1])
-    temp_dir = tempfile.gettempdir()
+    file_name = output_name(fname)
     if ext.lower() == '.zip':
-        yield "Unzipping file..."
-        temp_unzip_dir = os.path.join(temp_dir, file_name)
-        try:
-            rmtree(temp_unzip_dir)
-        except:
-            pass
-        os.mkdir(temp_unzip_dir)
-        with ZipFile(fname, 'r') as zipObj:
-            zipObj.extract(temp_unzip_dir)
-            files = [os.path.join(temp_unzip_dir, f) for f in os.listdir(temp_unzip_dir)]
+        lines = process_zip(fname, dest_dir, file_name, cache_dir, options=options)
     elif ext.lower() == '.pdf':
-        files = [fname]
+        lines = process_files([fname], dest_dir, file_name, cache_dir, options)
     else:
         raise Exception(
             "Unsupported file format (%s) accepted formats are: .pdf, .zip(containing pdf files)" % ext)
 
-    file_name = '.'.join(os.path.splitext(os.path.split(fname)[-1])[:-1])
-    for line in process_files(files, dest_dir, file_name):
+    for line in lines:
         yield line
 
 
-def process_files(files, dest_dir, dest_name):
+def process_files(files, dest_dir, dest_name, cache_dir=None, options=None):
     for file in files:
         yield "Processing file [%s] ..." % file
         ext = os.path.splitext(file)[-1]
-        output_file = os.path.join(dest_dir, dest_name + ".html")
-        if os.path.exists(output_file):
-            raise Exception("Output target (%s) already exists. Please delete or rename current file before upload.")
+        output_file = catalog.path_for(dest_dir, dest_name + ".html")
+        if os.path.exists(output_file) and not is_preview(output_file):
+            raise Exception("Output target (%s) already exists. Please delete or rename current file before upload."
+                            % output_file)
         if ext.lower() == ".pdf":
-            yield "Converting PDF to HTML"
-            convert_from_path(file,
-                              single_file=True,
-                              output_file=output_file,
-                              # complex_styles=True,
-                              embed_images=True,
-                              no_frames=True,
-                              # no_images=True,
-                              center_pages=True,
-                              no_bg_color=True,
-                              # title_from_file_name=True
-                              )
-            yield "Detecting h# tags in " + output_file
-            detect_tags(output_file)
+            names = [dest_name + ".html"] + ([dest_name + ".ndjson"] if PAGE_RECORDS else [])
+            with staged_outputs(dest_dir, names) as temp_files:
+                records_file = temp_files[1] if PAGE_RECORDS else None
+                for line in convert_pdf(file, temp_files[0], cache_dir, options=options, records_file=records_file):
+                    yield line
+                for temp_file in temp_files:
+                    yield compress_output(temp_file)
         else:
             raise Exception("Unsupported file type (%s) please only include [.pdf, .zip] files." % ext)
 
 
+@contextmanager
+def staged_outputs(dest_dir, names):
+    """
+        Temp paths to write the outputs names of dest_dir to. When the block succeeds they replace those in
+        dest_dir, along with their precompressed variants, and are added to the catalog. Otherwise (failure,
+        cancellation or timeout) they are removed, so no partial output is served or listed.
+    """
+    paths = [catalog.path_for(dest_dir, name) for name in names]
+    temp_dirs = []
+    try:
+        for path in paths:
+            mkdir_p(os.path.dirname(path))
+            # Hidden next to its destination, so the move is a rename and catalog.sync skips it
+            temp_dirs.append(tempfile.mkdtemp(prefix=".", suffix=".tmp", dir=os.path.dirname(path)))
+        temp_files = [os.path.join(temp_dir, os.path.basename(path)) for temp_dir, path in zip(temp_dirs, paths)]
+        yield temp_files
+
+        moved = []
+        try:
+            for name, temp_file, path in zip(names, temp_files, paths):
+                compression.remove_variants(path)
+                os.replace(temp_file, path)
+                moved.append(name)
+                for suffix in compression.SUFFIXES.values():
+                    if os.path.exists(temp_file + suffix):
+                        os.replace(temp_file + suffix, path + suffix)
+            for name in names:
+                catalog.add(dest_dir, name)
+        except BaseException:
+            # All of them or none
+            for name in moved:
+                remove_output(dest_dir, name)
+            raise
+    finally:
+        for temp_dir in temp_dirs:
+            rmtree(temp_dir, ignore_errors=True)
+
+
+def remove_output(dest_dir, name):
+    """Removes the output name of dest_dir, its precompressed variants and its catalog row"""
+    path = catalog.path_for(dest_dir, name)
+    if os.path.exists(path):
+        os.remove(path)
+    compression.remove_variants(path)
+    catalog.remove(dest_dir, name)
+
+
+def convert_pdf(file, output_file, cache_dir=None, page_workers=PAGE_WORKERS, options=None, records_file=None):
+    key = None
+    if cache_dir:
+        key = cache.cache_key(file, cache_options(options), get_poppler_version())
+        if cache.fetch(cache_dir, key, output_file, records_file):
+            record_cache_hit(output_file)
+            yield "Loaded from conversion cache [%s]" % key
+            return
+    yield "Converting PDF to HTML"
+    timings = {}
+    convert_from_path(file,
+                      output_file=output_file,
+                      parallel=page_workers,
+                      timings=timings,
+                      cpu_limit=PDFTOHTML_CPU_SECONDS,
+                      memory_limit=PDFTOHTML_MEMORY_BYTES,
+                      **conversion_options(options))
+    if "images_before_bytes" in timings:
+        yield images_report(timings)
+    yield "Detecting h# tags in " + output_file
+    pages = finish_pdf(file, output_file, cache_dir, key, timings, records_file)
+    if records_file:
+        yield "Wrote %d page records to %s" % (pages, os.path.basename(records_file))
+
+
+async def convert_pdf_async(file, output_file, cache_dir=None, executor=None):
+    """
+        convert_pdf for asyncio callers, yields the same progress lines and runs blocking steps in executor
+        (the loop's default one if None)
+    """
+    loop = asyncio.get_running_loop()
+    key = None
+    if cache_dir:
+        key = await loop.run_in_executor(executor, cache.cache_key, file, cache_options(), get_poppler_version())
+        if await loop.run_in_executor(executor, cache.fetch, cache_dir, key, output_file):
+            await loop.run_in_executor(executor, record_cache_hit, output_file)
+            yield "Loaded from conversion cache [%s]" % key
+            return
+    yield "Converting PDF to HTML"
+    timings = {}
+    await convert_from_path_async(file,
+                                  output_file=output_file,
+                                  timings=timings,
+                                  cpu_limit=PDFTOHTML_CPU_SECONDS,
+                                  memory_limit=PDFTOHTML_MEMORY_BYTES,
+                                  executor=executor,
+                                  **conversion_options())
+    if "images_before_bytes" in timings:
+        yield images_report(timings)
+    yield "Detecting h# tags in " + output_file
+    await loop.run_in_executor(executor, finish_pdf, file, output_file, cache_dir, key, timings)
+
+
+def preview_file(fname, dest_dir, pages=PREVIEW_PAGES, options=None):
+    """
+        Converts the first pages of fname to its output html in dest_dir right away, without images or h# tags,
+        for a full conversion to replace later. Returns the name of the html.
+    """
+    if os.path.splitext(fname)[-1].lower() != '.pdf':
+        raise Exception("Only .pdf files can be previewed")
+    name = output_name(fname) + ".html"
+    output_file = catalog.path_for(dest_dir, name)
+    if os.path.exists(output_file) and not is_preview(output_file):
+        raise Exception("%s was converted already, delete it to convert again" % name)
+    # Converted in the request thread, outside the job queue
+    if not _previews.acquire(blocking=False):
+        raise Exception("%d previews are already being converted, please try again later" % PREVIEW_WORKERS)
+    try:
+        _convert_preview(fname, dest_dir, name, output_file, pages, options)
+    finally:
+        _previews.release()
+    return name
+
+
+def _convert_preview(fname, dest_dir, name, output_file, pages, options):
+    mkdir_p(os.path.dirname(output_file))
+
+    start = time.perf_counter()
+    options = dict(conversion_options(options), no_images=True, embed_images=False, first_page=1, last_page=pages)
+    options.pop("asset_dir", None)
+    options.pop("optimize_images", None)
+    convert_from_path(fname, output_file=output_file,
+                      cpu_limit=PDFTOHTML_CPU_SECONDS,
+                      memory_limit=PDFTOHTML_MEMORY_BYTES,
+                      **options)
+    # Only the first pages without images, small enough to rewrite in memory
+    with open(output_file, errors="surrogateescape") as f:
+        html = f.read()
+    banner = PREVIEW_MARKER + '<p style="text-align:center">Preview of the first %d page(s), ' \
+                              'replaced by the full conversion once it is done.</p>\n' % pages
+    html = re.sub("(<body[^>]*>\n?)", lambda m: m.group(1) + banner, html, count=1)
+    temp_file = output_file + ".tmp"
+    with open(temp_file, "w", errors="surrogateescape") as f:
+        f.write(html)
+    os.replace(temp_file, output_file)
+    # A full conversion's variants would be served in place of the preview
+    compression.remove_variants(output_file)
+    catalog.add(dest_dir, name)
+    metrics.observe("pdf2html_stage_duration_seconds", time.perf_counter() - start, stage="preview")
+
+
+def discard_preview(fname, dest_dir, *args):
+    """
+        Removes the preview of fname from dest_dir, if it is still one, once the conversion that was to replace
+        it failed. Takes the arguments of process_file, see start_processing.
+    """
+    name = output_name(fname) + ".html"
+    output_file = catalog.path_for(dest_dir, name)
+    if os.path.exists(output_file) and is_preview(output_file):
+        remove_output(dest_dir, name)
+
+
+def is_preview(output_file):
+    with open(output_file, errors="surrogateescape") as f:
+        for line in f:
+            if line.startswith(PREVIEW_MARKER):
+                return True
+            if line.startswith("<!-- Page"):
+                return False
+    return False
+
+
+def images_report(timings):
+    before, after = timings["images_before_bytes"], timings["images_after_bytes"]
+    return "Optimized images: %d bytes -> %d bytes (%.1f%%) in %.2fs" % (
+        before, after, 100.0 * after / before if before else 100.0, timings["optimize_images"])
+
+
+def finish_pdf(file, output_file, cache_dir, key, timings, records_file=None):
+    """Post-processes the converted html, writes the page records if records_file is given and returns their count"""
+    if STRIP_REPEATED:
+        start = time.perf_counter()
+        strip_repeated(output_file, STRIP_REPEATED == "drop")
+        timings["strip_repeated"] = time.perf_counter() - start
+    pages = 0
+    # The xml engine and the page records share a single pdftohtml -xml run
+    with pdftohtml_xml(file) if TAG_ENGINE == "xml" and records_file else nullcontext() as xml_file:
+        start = time.perf_counter()
+        if xml_file:
+            detect_tags_xml(output_file, file, xml_file)
+        else:
+            detect_tags(output_file, TAG_ENGINE, file)
+        timings["detect_tags"] = time.perf_counter() - start
+        if records_file:
+            start = time.perf_counter()
+            pages = write_page_records(file, records_file, output_file, xml_file)
+            timings["page_records"] = time.perf_counter() - start
+    if key:
+        cache.store(cache_dir, key, output_file, CACHE_MAX_BYTES, records_file)
+    record_conversion(file, output_file, timings)
+    return pages
+
+
+def record_cache_hit(output_file):
+    metrics.inc("pdf2html_documents_total", source="cache")
+    metrics.inc("pdf2html_output_bytes_total", os.path.getsize(output_file))
+
+
+def record_conversion(file, output_file, timings):
+    observations = [("pdf2html_stage_duration_seconds", seconds, metrics.DURATION_BUCKETS, {"stage": stage})
+                    for stage, seconds in timings.items() if not stage.endswith("_bytes")]
+    if "pdftohtml_peak_rss_bytes" in timings:
+        observations.append(("pdf2html_pdftohtml_peak_rss_bytes", timings["pdftohtml_peak_rss_bytes"],
+                             metrics.BYTES_BUCKETS, {}))
+    metrics.observe_many(observations)
+    metrics.inc("pdf2html_documents_total", source="pdftohtml")
+    metrics.inc("pdf2html_input_bytes_total", os.path.getsize(file))
+    metrics.inc("pdf2html_output_bytes_total", os.path.getsize(output_file))
+
+
+# Page by page streaming
+
+_streams = threading.BoundedSemaphore(STREAM_WORKERS)
+_previews = threading.BoundedSemaphore(PREVIEW_WORKERS)
+
+
+def stream_pdf(file):
+    """
+        Yields the html of file while it is being converted, a few pages at a time, for the browser to render
+        as it arrives. Nothing is stored and h# tags are left out, their levels depend on the whole document.
+    """
+    if not _streams.acquire(blocking=False):
+        yield "<p>%d documents are already being streamed, please try again later.</p>" % STREAM_WORKERS
+        return
+    try:
+        for html in stream_from_path(file, max_chunk_pages=STREAM_MAX_CHUNK_PAGES,
+                                     title=os.path.basename(file),
+                                     cpu_limit=PDFTOHTML_CPU_SECONDS,
+                                     memory_limit=PDFTOHTML_MEMORY_BYTES,
+                                     **conversion_options()):
+            yield html
+    except Exception as ex:
+        yield "<p>[EXCEPTION] %s</p>" % escape(repr(ex))
+    finally:
+        _streams.release()
+
+
+# ZIP batches
+
+
+def process_zip(zip_path, dest_dir, dest_name, cache_dir=None, workers=BATCH_WORKERS, options=None):
+    """
+        Converts every pdf in the archive to its own <dest_name>-<member>.html. Members are extracted
+        only when a worker is about to take them and converted concurrently, a failing member is
+        reported and the rest of the batch carries on.
+    """
+    yield "Processing archive [%s] ..." % zip_path
+    temp_dir = tempfile.mkdtemp()
+    failed = []
+    converted = 0
+    used_names = set()
+    try:
+        with ZipFile(zip_path, 'r') as zip_file, ProcessPoolExecutor(max_workers=workers) as pool:
+            members = [m for m in zip_file.infolist() if not m.is_dir()]
+            total = len(members)
+            yield "Found %d archive members" % total
+            members = iter(enumerate(members, 1))
+            pending = {}
+            while True:
+                # Keep a few members extracted ahead so workers never wait on the archive
+                while len(pending) < workers * 2:
+                    i, member = next(members, (None, None))
+                    if member is None:
+                        break
+                    if os.path.splitext(member.filename)[-1].lower() != ".pdf":
+                        yield "[%d/%d] Skipping [%s], not a pdf" % (i, total, member.filename)
+                        continue
+                    member_dir = os.path.join(temp_dir, str(i))
+                    os.mkdir(member_dir)
+                    member_path = os.path.join(member_dir, os.path.basename(member.filename))
+                    with zip_file.open(member) as src, open(member_path, 'wb') as dst:
+                        copyfileobj(src, dst, 1024 * 1024)
+                    output_name = "%s-%s.html" % (
+                        dest_name, re.sub("[^\\w.-]+", "_", os.path.splitext(member.filename)[0]))
+                    # Names such as "a b.pdf" and "a_b.pdf" come out the same, the member's index tells them apart
+                    while output_name in used_names:
+                        output_name = "%s-%d.html" % (output_name[:-len(".html")], i)
+                    used_names.add(output_name)
+                    pending[pool.submit(convert_member, member_path, dest_dir, output_name, cache_dir, options)] = \
+                        (i, member.filename, output_name)
+                    yield "[%d/%d] Converting [%s] to %s" % (i, total, member.filename, output_name)
+
+                if not pending:
+                    break
+
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    i, name, output_name = pending.pop(future)
+                    try:
+                        for line in future.result():
+                            yield "[%d/%d] [%s] %s" % (i, total, name, line)
+                        converted += 1
+                        yield "[%d/%d] Done [%s]" % (i, total, name)
+                    except Exception as ex:
+                        failed.append(name)
+                        yield "[%d/%d] FAILED [%s] %r" % (i, total, name, ex)
+                    rmtree(os.path.join(temp_dir, str(i)), ignore_errors=True)
+    finally:
+        rmtree(temp_dir, ignore_errors=True)
+
+    yield "Converted %d archive members, %d failed" % (converted, len(failed))
+    if failed:
+        raise Exception("Archive members failed: %s" % ", ".join(failed))
+
+
+def convert_member(pdf_path, dest_dir, output_name, cache_dir, options=None):
+    """Converts an archive member to output_name (and its page records) in dest_dir, returns the progress lines"""
+    output_file = catalog.path_for(dest_dir, output_name)
+    if os.path.exists(output_file):
+        raise Exception("Output target (%s) already exists." % output_file)
+    names = [output_name] + ([records_name(output_name)] if PAGE_RECORDS else [])
+    with staged_outputs(dest_dir, names) as temp_files:
+        # Members already run side by side, so each one gets a single pdftohtml process
+        lines = list(convert_pdf(pdf_path, temp_files[0], cache_dir, page_workers=None, options=options,
+                                 records_file=temp_files[1] if PAGE_RECORDS else None))
+        lines.extend(compress_output(temp_file) for temp_file in temp_files)
+    return lines
+
+
+def records_name(html_name):
+    return os.path.splitext(html_name)[0] + ".ndjson"
+
+
+def compress_output(output_file):
+    """Writes the precompressed variants the download routes serve, returns the progress line"""
+    start = time.perf_counter()
+    encodings = compression.precompress(output_file)
+    metrics.observe("pdf2html_stage_duration_seconds", time.perf_counter() - start, stage="compress")
+    return "Precompressed output (%s)" % (", ".join(encodings) or "disabled")
+
+
 # H# tag detection
 
 
@@ -72,6 +454,17 @@ def get_page(el):
     return parent["id"]
 
 
+def get_style_pos(style):
+    mx = re.findall("left:([0-9]+)", style)
+    my = re.findall("top:([0-9]+)", style)
+    x = y = None
+    if len(mx):
+        x = mx[0]
+    if len(my):
+        y = my[0]
+    return x, y
+
+
 def find_htag_candidates(soup):
     candidates = []
     for p in soup.find_all('p'):
@@ -79,20 +472,13 @@ def find_htag_candidates(soup):
         if len(children) != 1:
             continue
         child = children[0]
-        if child.name != "b":
+        if child.name != "b" or REPEATED_CLASS in p.get("class", []):
             continue
-        style = p["style"]
-        mx = re.findall("left:([0-9]+)", style)
-        my = re.findall("top:([0-9]+)", style)
-        x = y = None
-        if len(mx):
-            x = mx[0]
-        if len(my):
-            y = my[0]
         candidates.append({
             "p": p,
             "b": child,
-            "pos": (x, y),
+            "text": p.text,
+            "pos": get_style_pos(p["style"]),
             "page": get_page(p)
         })
 
@@ -109,7 +495,7 @@ def create_headers(candidates):
 
     headers = []
     for key, group in merged_candidates.items():
-        text = group[0]["p"].text
+        text = group[0]["text"]
         pattern = re.sub("[0-9]+", "*", text)
         num = re.sub("[^0-9]+", "", text)
         header = {"group": group, 'generic': False}
@@ -123,7 +509,7 @@ def create_headers(candidates):
             header['pattern'] = re.sub("[\\w\\s]", "*", text)
             header['alpha'] = re.sub("[^\\w\\s]", "", text)
             # print(header['pattern'], header['alpha'])
-        elif re.match("^[A-Z]", group[0]['p'].text):
+        elif re.match("^[A-Z]", group[0]['text']):
             header['pattern'] = "NONUM"
             header['generic'] = True
         else:
@@ -132,13 +518,7 @@ def create_headers(candidates):
     return headers
 
 
-def detect_tags(html_file):
-    soup = BeautifulSoup(open(html_file, errors="surrogateescape"), "html.parser")
-
-    candidates = find_htag_candidates(soup)
-
-    headers = create_headers(candidates)
-
+def assign_levels(headers):
     pattern_state = {}
     current_level = 0
     current_pattern = None
@@ -163,9 +543,28 @@ def detect_tags(html_file):
             current_level = pattern_state[pattern]
             delete_higher_than(current_level)
 
-        htag = soup.new_tag("h" + str(current_level))
-        g0 = header['group'][0]
-        htag['style'] = "all: unset;position:absolute; top: %spx; left: 0px;" % g0['pos'][1]
+        yield header, current_level
+
+
+def htag_style(header):
+    return "all: unset;position:absolute; top: %spx; left: 0px;" % header['group'][0]['pos'][1]
+
+
+def detect_tags(html_file, engine="soup", pdf_file=None):
+    if engine == "xml" and pdf_file is not None:
+        return detect_tags_xml(html_file, pdf_file)
+    if engine in ("stream", "xml"):
+        return detect_tags_streaming(html_file)
+
+    soup = BeautifulSoup(open(html_file, errors="surrogateescape"), "html.parser")
+
+    candidates = find_htag_candidates(soup)
+
+    headers = create_headers(candidates)
+
+    for header, level in assign_levels(headers):
+        htag = soup.new_tag("h" + str(level))
+        htag['style'] = htag_style(header)
         for g in header['group']:
             g['p']['style'] = re.sub("top:[^;]+;", "", g['p']['style'])
             g['p'].wrap(htag)
@@ -175,3 +574,446 @@ def detect_tags(html_file):
     # soup.find('body').insert(0, t)
     with open(html_file, "w", errors="surrogateescape") as f:
         f.write(str(soup))
+
+
+# Streaming h# tag detection
+#
+# Same candidates, headers and levels as the BeautifulSoup engine, but found with an event driven
+# scan that only keeps candidate positions, then applied while copying the file line by line.
+# Memory is bounded by the longest line (i.e. the largest embedded image), not the document.
+# Markup outside the wrapped paragraphs is passed through as is instead of being re-serialized.
+
+
+HEADING_TAGS = {"h%d" % level for level in range(1, 7)}
+
+VOID_TAGS = {"area", "base", "br", "col", "embed", "hr", "img", "input", "link", "meta", "param", "source",
+             "track", "wbr"}
+
+
+class HTagScanner(HTMLParser):
+    def __init__(self, any_paragraph=False):
+        super().__init__()
+        self.stack = []
+        self.candidates = []
+        # Every <p> is a candidate, not only those made of a single <b>
+        self.any_paragraph = any_paragraph
+
+    def add_child(self, kind):
+        if self.stack:
+            parent = self.stack[-1]
+            # Consecutive text is a single child, as in the soup
+            if kind == "#text" and parent["last"] == "#text":
+                return
+            parent["children"] += 1
+            parent["first"] = parent["first"] or kind
+            parent["last"] = kind
+
+    def handle_starttag(self, tag, attrs):
+        self.add_child(tag)
+        if tag in VOID_TAGS:
+            return
+        self.stack.append({
+            "tag": tag,
+            "attrs": dict(attrs),
+            "children": 0,
+            "first": None,
+            "last": None,
+            "start": self.getpos(),
+            "tag_len": len(self.get_starttag_text()),
+            "text": [] if tag == "p" else None
+        })
+
+    def handle_startendtag(self, tag, attrs):
+        self.add_child(tag)
+
+    def handle_data(self, data):
+        self.add_child("#text")
+        # The soup collapses whitespace only strings
+        if not data.strip(" \n\t\f\r"):
+            data = "\n" if "\n" in data else " "
+        for el in self.stack:
+            if el["text"] is not None:
+                el["text"].append(data)
+
+    def handle_comment(self, data):
+        self.add_child("#comment")
+
+    def handle_endtag(self, tag):
+        for i in range(len(self.stack) - 1, -1, -1):
+            if self.stack[i]["tag"] == tag:
+                break
+        else:
+            return
+        # Whatever is still open inside is closed implicitly right before this end tag
+        while len(self.stack) > i + 1:
+            self.close_element((self.getpos(), False))
+        self.close_element((self.getpos(), True))
+
+    def close(self):
+        super().close()
+        while self.stack:
+            self.close_element((self.getpos(), False))
+        self.candidates.sort(key=lambda c: c["start"])
+
+    def close_element(self, end):
+        el = self.stack[-1]
+        if el["tag"] == "p" and (self.any_paragraph or (el["children"] == 1 and el["first"] == "b")) \
+                and REPEATED_CLASS not in (el["attrs"].get("class") or "").split():
+            self.candidates.append({
+                "text": "".join(el["text"]),
+                "pos": get_style_pos(el["attrs"]["style"]),
+                "page": self.current_page(),
+                "heading": self.current_heading(),
+                "start": el["start"],
+                "end": end,
+                "tag_len": el["tag_len"]
+            })
+        self.stack.pop()
+
+    def current_heading(self):
+        for el in reversed(self.stack[:-1]):
+            if el["tag"] in HEADING_TAGS:
+                return el["tag"], el["attrs"].get("style") or ""
+        return None
+
+    def current_page(self):
+        tags = [el["tag"] for el in self.stack]
+        if "body" not in tags:
+            return None
+        page = tags.index("body") + 1
+        if page >= len(self.stack) - 1:
+            return None
+        return self.stack[page]["attrs"]["id"]
+
+
+def find_htag_candidates_streaming(html_file, any_paragraph=False):
+    scanner = HTagScanner(any_paragraph)
+    with open(html_file, errors="surrogateescape") as f:
+        for line in f:
+            scanner.feed(line)
+    scanner.close()
+    return scanner.candidates
+
+
+def detect_tags_streaming(html_file):
+    candidates = find_htag_candidates_streaming(html_file)
+
+    headers = create_headers(candidates)
+
+    apply_headers(html_file, assign_levels(headers))
+
+
+def apply_headers(html_file, leveled_headers):
+    """Wraps the candidates of every (header, level) in an h<level> tag, copying html_file line by line"""
+    splices = []
+    for header, level in leveled_headers:
+        header['level'] = level
+        header['held'] = []
+        last = max(header['group'], key=lambda g: g['start'])
+        for g in header['group']:
+            splices.append((g, partial(_wrap_captured, g, header, g is last)))
+    splice_elements(html_file, splices)
+
+
+def splice_elements(html_file, splices):
+    """
+        Copies html_file line by line, except for the elements of the (candidate, write) splices
+        which are passed to write(raw_html, out) instead
+    """
+    splices = sorted(splices, key=lambda s: s[0]['start'])
+    temp_file = html_file + ".tmp"
+    with open(html_file, errors="surrogateescape") as fin, open(temp_file, "w", errors="surrogateescape") as fout:
+        splices = iter(splices)
+        splice = next(splices, None)
+        captured = None
+        for lineno, line in enumerate(fin, 1):
+            col = 0
+            while True:
+                if captured is None:
+                    if splice is None or splice[0]['start'][0] != lineno:
+                        fout.write(line[col:])
+                        break
+                    fout.write(line[col:splice[0]['start'][1]])
+                    col = splice[0]['start'][1]
+                    captured = []
+
+                (end_line, end_col), explicit = splice[0]['end']
+                if end_line != lineno:
+                    captured.append(line[col:])
+                    break
+                if explicit:
+                    end_col = line.index(">", end_col) + 1
+                captured.append(line[col:end_col])
+                col = end_col
+
+                splice[1]("".join(captured), fout)
+                captured = None
+                splice = next(splices, None)
+                # Skip candidates nested in the one just wrapped
+                while splice is not None and splice[0]['start'] < (lineno, col):
+                    splice = next(splices, None)
+
+    os.replace(temp_file, html_file)
+
+
+def _wrap_captured(candidate, header, is_last, raw, out):
+    tag_len = candidate['tag_len']
+    start_tag = re.sub("""(style=)(["'])(.*?)\\2""",
+                       lambda m: m.group(1) + m.group(2) + re.sub("top:[^;]+;", "", m.group(3)) + m.group(2),
+                       raw[:tag_len], count=1)
+    header['held'].append(start_tag + raw[tag_len:])
+    if is_last:
+        htag = "h" + str(header['level'])
+        out.write('<%s style="%s">%s</%s>' % (htag, htag_style(header), "".join(header['held']), htag))
+        header['held'] = []
+
+
+# Repeated headers and footers
+
+
+def strip_repeated(html_file, drop=False):
+    """Marks the paragraphs found on many pages at the same position with REPEATED_CLASS, or drops them"""
+    paragraphs = find_htag_candidates_streaming(html_file, any_paragraph=True)
+    repeated = find_repeated([p["page"] or "" for p in paragraphs],
+                             [int(p["pos"][1] or -1) for p in paragraphs],
+                             [int(p["pos"][0] or -1) for p in paragraphs],
+                             [p["text"] for p in paragraphs])
+    splices = [(p, _drop_element if drop else partial(_mark_repeated, p))
+               for p, is_repeated in zip(paragraphs, repeated) if is_repeated]
+    if splices:
+        splice_elements(html_file, splices)
+    return len(splices)
+
+
+def _mark_repeated(candidate, raw, out):
+    tag_len = candidate['tag_len']
+    start_tag, n = re.subn("""(class=)(["'])(.*?)\\2""",
+                           lambda m: m.group(1) + m.group(2) + m.group(3) + " " + REPEATED_CLASS + m.group(2),
+                           raw[:tag_len], count=1)
+    if not n:
+        start_tag = start_tag[:-1] + ' class="%s">' % REPEATED_CLASS
+    out.write(start_tag + raw[tag_len:])
+
+
+def _drop_element(raw, out):
+    pass
+
+
+# Font metric h# tag detection
+#
+# pdftohtml -xml gives the font of every text line. The size most of the text is set in is the body,
+# every larger size is a heading level (largest first) and lines set entirely in bold at the body size
+# come right after them. The xml is read in a single pass and the levels go on the html paragraphs
+# starting at the same page and position, applied like the streaming engine's.
+# Both outputs come from the same pdftohtml text layout, a line found a couple of pixels off (or at
+# another left on its row) still matches. When most paragraphs match nothing, the html is tagged by
+# the streaming engine instead.
+
+MAX_HEADING_LEVEL = 6
+
+# Pixels the top of an html paragraph and of its xml line may be apart
+XML_POSITION_TOLERANCE = 2
+
+# Share of the html paragraphs that must match an xml line for the xml levels to be used
+XML_MIN_MATCH_SHARE = 0.5
+
+
+def detect_tags_xml(html_file, pdf_file, xml_file=None):
+    try:
+        with nullcontext(xml_file) if xml_file else pdftohtml_xml(pdf_file) as xml_file:
+            levels = rank_font_levels(xml_file)
+    except ElementTree.ParseError as ex:
+        print("Unreadable pdftohtml xml (%r), detecting h# tags from the html instead" % ex)
+        return detect_tags_streaming(html_file)
+
+    index = position_index(levels)
+    candidates = find_htag_candidates_streaming(html_file, any_paragraph=True)
+    headers = {}
+    matched = 0
+    for c in candidates:
+        page = re.sub("[^0-9]", "", c["page"] or "")
+        level = find_position(index, page, c["pos"][1], c["pos"][0])
+        if level is None:
+            continue
+        matched += 1
+        if not level:
+            continue
+        # Paragraphs on the same line are one heading, as in create_headers
+        header = headers.setdefault((page, c["pos"][1]), {"group": [], "level": level})
+        header["group"].append(c)
+        header["level"] = min(header["level"], level)
+
+    if matched < XML_MIN_MATCH_SHARE * len(candidates):
+        print("Only %d of %d paragraphs found in the pdftohtml xml, detecting h# tags from the html instead"
+              % (matched, len(candidates)))
+        return detect_tags_streaming(html_file)
+
+    apply_headers(html_file, [(header, header["level"]) for header in headers.values()])
+
+
+@contextmanager
+def pdftohtml_xml(pdf_file):
+    """The text only pdftohtml -xml output of pdf_file, in a temp dir removed on exit"""
+    temp_dir = tempfile.mkdtemp()
+    try:
+        convert_from_path(pdf_file, output_folder=temp_dir, xml=True, no_images=True,
+                          cpu_limit=PDFTOHTML_CPU_SECONDS, memory_limit=PDFTOHTML_MEMORY_BYTES)
+        yield os.path.join(temp_dir, os.path.splitext(os.path.basename(pdf_file))[0] + ".xml")
+    finally:
+        rmtree(temp_dir, ignore_errors=True)
+
+
+def rank_font_levels(xml_file):
+    """Heading level of the text lines of a pdftohtml xml file (0 for the others) by (page number, top, left)"""
+    fonts = {}
+    chars = {}
+    lines = []
+    page = None
+    for event, el in ElementTree.iterparse(xml_file, events=("start", "end")):
+        if event == "start":
+            if el.tag == "page":
+                page = el.get("number")
+            continue
+        if el.tag == "fontspec":
+            fonts[el.get("id")] = float(el.get("size", 0))
+        elif el.tag == "text":
+            text = "".join(el.itertext()).strip()
+            if text:
+                size = fonts.get(el.get("font"), 0)
+                chars[size] = chars.get(size, 0) + len(text)
+                bold = "".join("".join(b.itertext()) for b in el.iter("b")).strip() == text
+                lines.append((page, _coord(el.get("top")), _coord(el.get("left")), size, bold))
+            el.clear()
+        elif el.tag == "page":
+            el.clear()
+
+    if not chars:
+        return {}
+    body = max(chars, key=chars.get)
+    sizes = sorted((size for size in chars if size > body), reverse=True)
+    ranks = {size: min(i + 1, MAX_HEADING_LEVEL) for i, size in enumerate(sizes)}
+    bold_level = min(len(sizes) + 1, MAX_HEADING_LEVEL)
+
+    levels = {}
+    for page, top, left, size, bold in lines:
+        levels[(page, top, left)] = ranks.get(size) or (bold_level if bold and size == body else 0)
+    return levels
+
+
+def _coord(value):
+    # The html styles are whole pixels, see get_style_pos
+    return str(int(float(value or 0)))
+
+
+def position_index(positions):
+    """{(page number, top, left): value} as {page number: {top: [(left, value), ...]}} for find_position"""
+    index = {}
+    for (page, top, left), value in positions.items():
+        index.setdefault(page, {}).setdefault(int(float(top)), []).append((int(float(left or 0)), value))
+    return index
+
+
+def find_position(index, page, top, left):
+    """
+        Value at (page, top, left) in a position_index, else that of the line closest to it on the page,
+        at most XML_POSITION_TOLERANCE pixels above or below (and nearest left on the row). None if none.
+    """
+    rows = index.get(page)
+    if not rows or top is None:
+        return None
+    top, left = int(float(top)), int(float(left or 0))
+    best = None
+    for row in range(top - XML_POSITION_TOLERANCE, top + XML_POSITION_TOLERANCE + 1):
+        for line_left, value in rows.get(row, ()):
+            distance = (abs(row - top), abs(line_left - left))
+            if best is None or distance < best[0]:
+                best = (distance, value)
+    return best[1] if best else None
+
+
+# Page records
+#
+# One json object per line and page of the document, for indexing without parsing the html:
+# {"page": 1, "width": 918, "height": 1188, "texts": [{"top": 100, "left": 90, "width": 300, "height": 18,
+#  "text": "1 Scope", "font": {"size": 18, "family": "Times", "color": "#000000"}, "bold": true,
+#  "italic": false, "level": 1}, ...]}
+# Coordinates are those of the html, "level" is that of the h# tag the line got in the html or null,
+# whichever TAG_ENGINE found it.
+
+
+def write_page_records(pdf_file, records_file, html_file, xml_file=None):
+    """
+        Writes the page records of pdf_file to records_file and returns their count. Without the xml_file of an
+        earlier pdftohtml -xml run, each page is written as soon as pdftohtml gets it out.
+    """
+    levels = position_index(heading_levels(html_file))
+    pages = 0
+    temp_file = records_file + ".tmp"
+    with nullcontext(xml_file) if xml_file else xml_stream_from_path(
+            pdf_file, cpu_limit=PDFTOHTML_CPU_SECONDS, memory_limit=PDFTOHTML_MEMORY_BYTES) as xml, \
+            open(temp_file, "w") as out:
+        for record in read_page_records(xml, levels):
+            out.write(json.dumps(record) + "\n")
+            pages += 1
+    os.replace(temp_file, records_file)
+    return pages
+
+
+def heading_levels(html_file):
+    """
+        Level of the h# tag wrapping each paragraph of html_file (0 for body text) by its (page number, top, left).
+        Body paragraphs are kept so that a line next to a heading on its row matches its own paragraph.
+    """
+    levels = {}
+    for c in find_htag_candidates_streaming(html_file, any_paragraph=True):
+        page = re.sub("[^0-9]", "", c["page"] or "")
+        top, level = c["pos"][1], 0
+        if c["heading"] is not None:
+            tag, style = c["heading"]
+            # The top moved from the paragraph to the h# tag, see htag_style
+            top = top or next(iter(re.findall("top:\\s*([0-9]+)", style)), None)
+            level = int(tag[1:])
+        if top is not None:
+            levels[(page, top, c["pos"][0])] = level
+    return levels
+
+
+def read_page_records(xml_file, levels):
+    """The page records of a pdftohtml xml file, levels is the position_index of the html's heading_levels"""
+    fonts = {}
+    record = None
+    for event, el in ElementTree.iterparse(xml_file, events=("start", "end")):
+        if event == "start":
+            if el.tag == "page":
+                record = {"page": int(el.get("number")), "width": _number(el.get("width")),
+                          "height": _number(el.get("height")), "texts": []}
+            continue
+        if el.tag == "fontspec":
+            fonts[el.get("id")] = {"size": _number(el.get("size")), "family": el.get("family"),
+                                   "color": el.get("color")}
+        elif el.tag == "text":
+            text = "".join(el.itertext()).strip()
+            if text and record is not None:
+                top, left = el.get("top"), el.get("left")
+                record["texts"].append({
+                    "top": _number(top),
+                    "left": _number(left),
+                    "width": _number(el.get("width")),
+                    "height": _number(el.get("height")),
+                    "text": text,
+                    "font": fonts.get(el.get("font")),
+                    "bold": "".join("".join(b.itertext()) for b in el.iter("b")).strip() == text,
+                    "italic": "".join("".join(i.itertext()) for i in el.iter("i")).strip() == text,
+                    "level": find_position(levels, str(record["page"]), top, left) or None
+                })
+            el.clear()
+        elif el.tag == "page":
+            el.clear()
+            yield record
+            record = None
+
+
+def _number(value):
+    value = float(value or 0)
+    return int(value) if value.is_integer() else value
+
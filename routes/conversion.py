@@ -1,14 +1,20 @@
-from processing.manager import start_processing, create_worker
+from processing.manager import start_processing, cancel_processing, queue_position, pending_job, job_key, \
+    queue_full, QueueFullError
 import tempfile
-from flask import Blueprint, send_from_directory, render_template, redirect, flash, Response
-from upload.manager import upload_to
+from flask import Blueprint, render_template, redirect, flash, Response, jsonify, request
+from upload.manager import upload_to, upload_chunk, prune_store
 from helpers.functions import mkdir_p
-from logs.logger import yield_log, clear_log
-from files.manager import delete_file, view_files
+from logs.logger import yield_log, clear_log, log_events, stream_log
+from logs.events import append_event
+from files.manager import delete_file, view_files, file_info, download_file
 from security.auth import ensure_secure
+from cache.manager import stats as cache_stats
+from catalog import manager as catalog
 import os
 
-from processors.conversion import process_file
+from processors.conversion import process_file, stream_pdf, preview_file, discard_preview, remove_output, \
+    REQUEST_OPTIONS
+from config.conversion import PREVIEW_PAGES, PREVIEW_MAX_PAGES
 
 prefix = __name__.split('.')[-1]
 
@@ -18,14 +24,18 @@ UPLOAD_FOLDER = BASE_DIR+'/storage/uploads/' + prefix
 PROC_FOLDER = BASE_DIR+'/storage/processed/' + prefix
 LOG_DIR = BASE_DIR+'/storage/logs/' + prefix
 CACHE_DIR = BASE_DIR+'/storage/cache/' + prefix
+STORE_DIR = BASE_DIR+'/storage/store/' + prefix
 
 bp = Blueprint(prefix, __name__, template_folder='templates')
 ACCEPTED_EXTENSIONS = ['pdf', 'zip']
 
-for d in [UPLOAD_FOLDER, PROC_FOLDER, LOG_DIR, CACHE_DIR]:
+for d in [UPLOAD_FOLDER, PROC_FOLDER, LOG_DIR, CACHE_DIR, STORE_DIR]:
     if not os.path.exists(d):
         mkdir_p(os.path.abspath(d))
 
+for d in [UPLOAD_FOLDER, PROC_FOLDER]:
+    catalog.sync(d)
+
 
 @bp.before_request
 def sec_pass():
@@ -36,14 +46,12 @@ def sec_pass():
 
 @bp.route('/proc/download/<string:fname>')
 def dl_proc(fname):
-    fname = fname.strip('.')
-    return send_from_directory(PROC_FOLDER, fname)
+    return download_file(PROC_FOLDER, fname)
 
 
 @bp.route('/raw/download/<string:fname>')
 def dl_raw(fname):
-    fname = fname.strip('.')
-    return send_from_directory(UPLOAD_FOLDER, fname)
+    return download_file(UPLOAD_FOLDER, fname)
 
 
 @bp.route('/proc/del/<fname>')
@@ -55,6 +63,7 @@ def del_proc(fname):
 @bp.route('/raw/del/<fname>')
 def del_raw(fname):
     delete_file(UPLOAD_FOLDER, fname)
+    prune_store(STORE_DIR)
     return redirect('/' + prefix + '/raw/view')
 
 
@@ -79,6 +88,10 @@ def view_raw():
             "Download": '/' + prefix + "/raw/download/{file}",
             "Delete": '/' + prefix + "/raw/del/{file}",
             "Process": '/' + prefix + "/raw/process/{file}",
+            "Preview": '/' + prefix + "/raw/process/{file}?profile=preview",
+            "Stream": '/' + prefix + "/raw/stream/{file}",
+            "Cancel": '/' + prefix + "/raw/cancel/{file}",
+            "Info": '/' + prefix + "/raw/info/{file}",
             "View Log": '/' + prefix + "/raw/log/view/{file}",
             "Clear Log": '/' + prefix + "/raw/log/clear/{file}"
         },
@@ -86,33 +99,124 @@ def view_raw():
         header="Raw Files (PDF)")
 
 
+@bp.route('/raw/info/<fname>')
+def raw_info(fname):
+    return file_info(UPLOAD_FOLDER, fname)
+
+
+def get_logf(fname):
+    return os.path.join(LOG_DIR, fname.strip('.') + '.jsonl')
+
+
 @bp.route('/raw/log/view/<fname>')
 def view_log(fname):
-    logf = os.path.join(LOG_DIR, fname + '.log')
-    return yield_log(logf, '/' + prefix + '/raw/view')
+    logf = get_logf(fname)
+    return yield_log(logf, '/' + prefix + '/raw/view', '/' + prefix + '/raw/log/stream/' + fname,
+                     queue_position(logf))
+
+
+@bp.route('/raw/log/events/<fname>')
+def view_log_events(fname):
+    logf = get_logf(fname)
+    return log_events(logf, request.args.get('offset', 0, type=int), queue_position(logf))
+
+
+@bp.route('/raw/log/stream/<fname>')
+def stream_log_events(fname):
+    offset = request.headers.get('Last-Event-ID', type=int)
+    if offset is None:
+        offset = request.args.get('offset', 0, type=int)
+    return stream_log(get_logf(fname), offset)
 
 
 @bp.route('/raw/log/clear/<fname>')
 def del_log_file(fname):
-    logf = os.path.join(LOG_DIR, fname + '.log')
+    logf = get_logf(fname)
     return clear_log(logf, '/'+prefix+'/raw/view')
 
 
+def request_options():
+    """Conversion options set by the request, e.g. ?center_pages=0&no_images=1"""
+    return {k: bool(request.args.get(k, type=int)) for k in REQUEST_OPTIONS if k in request.args}
+
+
 @bp.route('/raw/process/<fname>')
 def proc_raw(fname):
-    logf = os.path.join(LOG_DIR, fname + '.log')
-    do_work = create_worker(process_file, (os.path.join(UPLOAD_FOLDER, fname), PROC_FOLDER), prefix, logf)
-    start_processing(do_work, logf)
+    """Queues the conversion of fname, with ?profile=preview its first ?pages= are converted before it's queued"""
+    logf = get_logf(fname)
+    path = catalog.path_for(UPLOAD_FOLDER, fname)
+    if not os.path.isfile(path):
+        flash('No such file.')
+        return redirect('/' + prefix + '/raw/view')
+    options = request_options()
+    key = job_key(path, options)
+    preview = None
+    # No new preview while the document is being converted already, nor for a job the queue can't take
+    if request.args.get('profile') == 'preview' and not pending_job(key):
+        if queue_full():
+            flash('Processing queue is full, please try again later.')
+            return redirect('/' + prefix + '/raw/view')
+        pages = min(max(request.args.get('pages', PREVIEW_PAGES, type=int), 1), PREVIEW_MAX_PAGES)
+        try:
+            preview = preview_file(path, PROC_FOLDER, pages, options)
+        except Exception as ex:
+            flash('Preview failed: %s' % ex)
+            return redirect('/' + prefix + '/raw/view')
+    try:
+        # A double click, a retry or a second user follow the job already converting the same file.
+        # A preview left by a job that fails would pass for the document, it goes with the failure.
+        start_processing(process_file, (path, PROC_FOLDER, CACHE_DIR, options), prefix, logf, key,
+                         on_failure=discard_preview)
+    except QueueFullError:
+        if preview:
+            # Filled up in the meantime, no conversion would ever replace the preview
+            remove_output(PROC_FOLDER, preview)
+        flash('Processing queue is full, please try again later.')
+        return redirect('/' + prefix + '/raw/view')
+    if preview:
+        append_event(logf, "preview", "Preview of the first %d page(s): <a href='/%s/proc/download/%s'>%s</a>"
+                     % (pages, prefix, preview, preview))
 
     return redirect('/' + prefix + "/raw/log/view/" + fname)
 
 
+@bp.route('/raw/stream/<fname>')
+def stream_raw(fname):
+    path = catalog.path_for(UPLOAD_FOLDER, fname.strip('.'))
+    if os.path.splitext(fname)[-1].lower() != '.pdf' or not os.path.isfile(path):
+        flash('Only uploaded .pdf files can be streamed.')
+        return redirect('/' + prefix + '/raw/view')
+    # Sent as each chunk of pages is converted, proxies must not hold it back
+    return Response(stream_pdf(path), mimetype='text/html',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@bp.route('/raw/cancel/<fname>')
+def cancel_raw(fname):
+    if cancel_processing(get_logf(fname)):
+        flash('Cancelling, the log shows when the job has stopped.')
+        return redirect('/' + prefix + "/raw/log/view/" + fname)
+    flash('No pending job for this file.')
+    return redirect('/' + prefix + '/raw/view')
+
+
+@bp.route('/cache/stats')
+def view_cache_stats():
+    return jsonify(cache_stats(CACHE_DIR))
+
+
 @bp.route('/upload', methods=['POST'])
 def upload_file():
-    return upload_to(UPLOAD_FOLDER, ACCEPTED_EXTENSIONS)
+    return upload_to(UPLOAD_FOLDER, ACCEPTED_EXTENSIONS, STORE_DIR)
+
+
+@bp.route('/upload/resumable/<upload_id>', methods=['GET', 'PUT'])
+def upload_file_chunk(upload_id):
+    return upload_chunk(UPLOAD_FOLDER, STORE_DIR, upload_id, ACCEPTED_EXTENSIONS)
 
 
 @bp.route('/upload')
 def upload_form():
     return render_template('upload.html', title="Upload Raw - PDF", header="Upload Raw File (PDF)",
-                           accept=','.join(['.'+e for e in ACCEPTED_EXTENSIONS]))
+                           accept=','.join(['.'+e for e in ACCEPTED_EXTENSIONS]),
+                           resumable_url='/' + prefix + '/upload/resumable/')
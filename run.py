@@ -1,10 +1,18 @@
 # Based on https://www.roytuts.com/python-flask-file-upload-example/
 import os
-from flask import Flask, render_template, send_from_directory
-from security.auth import bp as auth_bp
+import hmac
+from flask import Flask, Response, render_template, send_from_directory, request
+from security.auth import bp as auth_bp, verify_token
 from routes.conversion import bp as conversion_bp
+from processing.manager import pool_gauges
+from metrics.collector import render as render_metrics
+from files.manager import download_asset
+from upload.manager import UploadRequest
+from config.conversion import ASSET_DIR
+from config.processing import METRICS_TOKEN
 
 app = Flask(__name__)
+app.request_class = UploadRequest
 app.secret_key = os.urandom(24)
 app.config['MAX_CONTENT_LENGTH'] = 500 * 1024 * 1024
 
@@ -25,5 +33,22 @@ def get_img(fname):
     return send_from_directory(img_dir, fname)
 
 
+@app.route('/assets/<string:fname>')
+def get_asset(fname):
+    return download_asset(ASSET_DIR, fname)
+
+
+@app.route('/metrics')
+def get_metrics():
+    # As in the api, scrapers send "Authorization: Bearer <token>" and browsers the token cookie
+    header = request.headers.get('Authorization', '')
+    bearer = header[len('Bearer '):] if header.startswith('Bearer ') else None
+    if not (verify_token(bearer, False) or verify_token(request.cookies.get('token'))
+            or (METRICS_TOKEN and bearer and hmac.compare_digest(bearer, METRICS_TOKEN))):
+        return Response('Missing or invalid token\n', status=401, mimetype='text/plain',
+                        headers={'WWW-Authenticate': 'Bearer'})
+    return Response(render_metrics(pool_gauges()), mimetype='text/plain; version=0.0.4')
+
+
 if __name__ == "__main__":
     app.run(host='0.0.0.0', port=8080, use_reloader=False, debug=False)
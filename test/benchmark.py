@@ -0,0 +1,181 @@
+"""
+    Conversion benchmark: generates a synthetic PDF corpus offline and times every pipeline stage.
+    Each case runs in a fresh process so the peak RSS it reports belongs to that case alone.
+
+    python test/benchmark.py --pages 10 100 --density 40 --images 0 2 --output bench.json
+"""
+
+import os
+import sys
+import json
+import time
+import zlib
+import random
+import shutil
+import argparse
+import resource
+import platform
+import tempfile
+import itertools
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from helpers.pdf2html import convert_from_path, get_poppler_version
+from processors.conversion import conversion_options, detect_tags, strip_repeated
+from config.conversion import STRIP_REPEATED
+
+WORDS = ("fire", "code", "building", "section", "inspection", "authority", "system", "alarm", "exit", "safety",
+         "requirement", "occupancy", "storage", "tank", "installation", "maintenance", "approved", "shall")
+
+
+def generate_pdf(path, pages, lines_per_page, images_per_page, image_size=128, seed=0):
+    """Writes a plain PDF 1.4 with numbered bold headings, body text lines and RGB images on every page"""
+    rnd = random.Random(seed)
+    objects = []
+
+    def add(body):
+        objects.append(body)
+        return len(objects)
+
+    def stream(dictionary, data):
+        return b"<< %s /Length %d >>\nstream\n" % (dictionary, len(data)) + data + b"\nendstream"
+
+    def text(s):
+        return "(%s)" % s.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+    catalog = add(None)
+    page_tree = add(None)
+    font = add(b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+    bold = add(b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica-Bold >>")
+
+    kids = []
+    leading = min(12.0, 680.0 / max(lines_per_page, 1))
+    for p in range(pages):
+        xobjects = []
+        for i in range(images_per_page):
+            pixels = bytes(rnd.getrandbits(8) for _ in range(image_size * image_size * 3 // 16)) * 16
+            xobjects.append(add(stream(
+                b"/Type /XObject /Subtype /Image /Width %d /Height %d /ColorSpace /DeviceRGB "
+                b"/BitsPerComponent 8 /Filter /FlateDecode" % (image_size, image_size),
+                zlib.compress(pixels))))
+
+        content = []
+        y = 750.0
+        for line in range(lines_per_page):
+            if line % 10 == 0:
+                content.append("BT /F2 %.1f Tf 72 %.1f Td %s Tj ET" % (
+                    leading, y, text("%d.%d %s" % (p + 1, line // 10 + 1, " ".join(rnd.sample(WORDS, 3)).title()))))
+            else:
+                content.append("BT /F1 %.1f Tf 72 %.1f Td %s Tj ET" % (
+                    leading * 0.8, y, text(" ".join(rnd.choice(WORDS) for _ in range(12)))))
+            y -= leading
+        for i in range(len(xobjects)):
+            content.append("q 100 0 0 100 %d %d cm /Im%d Do Q" % (72 + (i % 4) * 110, 60 + (i // 4) * 110, i))
+        contents = add(stream(b"", "\n".join(content).encode("latin-1")))
+
+        resources = b"<< /Font << /F1 %d 0 R /F2 %d 0 R >> /XObject << %s >> >>" % (
+            font, bold, b" ".join(b"/Im%d %d 0 R" % (i, x) for i, x in enumerate(xobjects)))
+        kids.append(add(b"<< /Type /Page /Parent %d 0 R /MediaBox [0 0 612 792] /Resources %s /Contents %d 0 R >>"
+                        % (page_tree, resources, contents)))
+
+    objects[catalog - 1] = b"<< /Type /Catalog /Pages %d 0 R >>" % page_tree
+    objects[page_tree - 1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (
+        b" ".join(b"%d 0 R" % k for k in kids), len(kids))
+
+    with open(path, "wb") as f:
+        f.write(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+        offsets = []
+        for i, body in enumerate(objects, 1):
+            offsets.append(f.tell())
+            f.write(b"%d 0 obj\n" % i + body + b"\nendobj\n")
+        xref = f.tell()
+        f.write(b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1))
+        for offset in offsets:
+            f.write(b"%010d 00000 n \n" % offset)
+        f.write(b"trailer\n<< /Size %d /Root %d 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, catalog, xref))
+
+
+def run_case(case):
+    temp_dir = tempfile.mkdtemp()
+    try:
+        pdf = os.path.join(temp_dir, "bench.pdf")
+        generate_pdf(pdf, case["pages"], case["density"], case["images"], case["image_size"], case["seed"])
+        output_file = os.path.join(temp_dir, "out", "bench.html")
+        os.mkdir(os.path.dirname(output_file))
+
+        timings = {}
+        start = time.perf_counter()
+        convert_from_path(pdf, output_file=output_file, parallel=case["workers"], timings=timings,
+                          **conversion_options())
+        if STRIP_REPEATED:
+            strip_start = time.perf_counter()
+            strip_repeated(output_file, STRIP_REPEATED == "drop")
+            timings["strip_repeated"] = time.perf_counter() - strip_start
+        tags_start = time.perf_counter()
+        detect_tags(output_file, case["engine"], pdf)
+        end = time.perf_counter()
+        timings["detect_tags"] = end - tags_start
+        timings["total"] = end - start
+
+        # ru_maxrss is in kilobytes on Linux and bytes on macOS
+        rss_unit = 1 if platform.system() == "Darwin" else 1024
+        return dict(case,
+                    input_bytes=os.path.getsize(pdf),
+                    output_bytes=os.path.getsize(output_file),
+                    timings=timings,
+                    peak_rss_bytes=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * rss_unit,
+                    children_peak_rss_bytes=resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * rss_unit)
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pages", type=int, nargs="+", default=[10, 100])
+    parser.add_argument("--density", type=int, nargs="+", default=[40], help="Text lines per page")
+    parser.add_argument("--images", type=int, nargs="+", default=[0, 2], help="Images per page")
+    parser.add_argument("--image-size", type=int, default=128, help="Image width and height in pixels")
+    parser.add_argument("--engine", nargs="+", default=["stream"], choices=["stream", "soup", "xml"])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1], help="pdftohtml processes per document")
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--output", help="Write the JSON results here instead of stdout")
+    parser.add_argument("--case", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case:
+        print(json.dumps(run_case(json.loads(args.case))))
+        return
+
+    results = []
+    for pages, density, images, engine, workers, run in itertools.product(
+            args.pages, args.density, args.images, args.engine, args.workers, range(args.repeat)):
+        case = {"pages": pages, "density": density, "images": images, "image_size": args.image_size,
+                "engine": engine, "workers": workers, "run": run, "seed": run}
+        proc = subprocess.run([sys.executable, os.path.abspath(__file__), "--case", json.dumps(case)],
+                              stdout=subprocess.PIPE, universal_newlines=True, check=True)
+        result = json.loads(proc.stdout.strip().splitlines()[-1])
+        results.append(result)
+        sys.stderr.write("pages=%-5d density=%-4d images=%-3d engine=%-6s workers=%-3d total=%.3fs rss=%.1fMB\n" % (
+            pages, density, images, engine, workers, result["timings"]["total"], result["peak_rss_bytes"] / 2 ** 20))
+
+    report = json.dumps({
+        "meta": {
+            "poppler_version": get_poppler_version(),
+            "python_version": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "strip_repeated": STRIP_REPEATED,
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S")
+        },
+        "results": results
+    }, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report)
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,7 @@
+import os
+import tempfile
+
+# The catalog and the metrics are created on import, keep them out of the repo's storage dir
+_storage = tempfile.mkdtemp(prefix="pdf2html-test-")
+os.environ.setdefault("PDF2HTML_CATALOG_FILE", os.path.join(_storage, "catalog.sqlite"))
+os.environ.setdefault("PDF2HTML_METRICS_FILE", os.path.join(_storage, "metrics", "metrics.json"))
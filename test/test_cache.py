@@ -0,0 +1,25 @@
+import os
+import time
+from cache import manager as cache
+
+
+def entry(cache_dir, key):
+    return os.path.join(cache_dir, key + ".html")
+
+
+def test_least_recently_used_entry_is_evicted_first(tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    os.mkdir(cache_dir)
+    output = tmp_path / "out.html"
+    output.write_text("x" * 100)
+    for age, key in ((30, "a"), (20, "b")):
+        cache.store(cache_dir, key, str(output), 1000)
+        os.utime(entry(cache_dir, key), (time.time() - age, time.time() - age))
+
+    # a is the older entry, fetching it makes b the least recently used one
+    assert cache.fetch(cache_dir, "a", str(tmp_path / "copy.html"))
+    cache.store(cache_dir, "c", str(output), 250)
+
+    assert sorted(name for name in os.listdir(cache_dir) if name.endswith(".html")) == ["a.html", "c.html"]
+    counters = cache.stats(cache_dir)
+    assert (counters["hits"], counters["evictions"], counters["entries"], counters["bytes"]) == (1, 1, 2, 200)
@@ -0,0 +1,68 @@
+import io
+import os
+import re
+from bs4 import BeautifulSoup
+from processors.conversion import detect_tags, heading_levels, position_index, read_page_records
+
+SAMPLE = os.path.join(os.path.dirname(__file__), "temp", "test.html")
+
+XML = '''<?xml version="1.0" encoding="UTF-8"?>
+<pdf2xml producer="poppler" version="0.86">
+<page number="1" position="absolute" top="0" left="0" height="1188" width="918">
+	<fontspec id="0" size="12" family="Times" color="#000000"/>
+	<fontspec id="1" size="18" family="Times" color="#000000"/>
+<text top="100" left="90" width="120" height="18" font="1"><b>2 Exits</b></text>
+<text top="101" left="500" width="200" height="13" font="0">right column text</text>
+<text top="140" left="90" width="600" height="13" font="0">Body text</text>
+</page>
+</pdf2xml>
+'''
+
+HTML = '''<!DOCTYPE html><html>
+<head>
+<title>Test</title>
+</head>
+<body>
+<div id="page1-div" style="position:relative;width:918px;height:1188px;">
+<h2 style="all: unset;position:absolute; top: 100px; left: 0px;"><p style="position:absolute;left:90px;white-space:nowrap" class="ft11"><b>2 Exits</b></p></h2>
+<p style="position:absolute;top:101px;left:500px;white-space:nowrap" class="ft10">right column text</p>
+<p style="position:absolute;top:140px;left:90px;white-space:nowrap" class="ft10">Body text</p>
+</div>
+</body>
+</html>
+'''
+
+
+def test_body_text_on_a_heading_row_keeps_no_level(tmp_path):
+    html_file = tmp_path / "doc.html"
+    html_file.write_text(HTML)
+    levels = position_index(heading_levels(str(html_file)))
+    records = list(read_page_records(io.BytesIO(XML.encode()), levels))
+
+    assert [(t["text"], t["level"]) for t in records[0]["texts"]] == [
+        ("2 Exits", 2), ("right column text", None), ("Body text", None)]
+
+
+def unwrap_headings(html):
+    # Back to the pdftohtml output: the h# tags go and their paragraphs get their top back, see htag_style
+    def unwrap(m):
+        return m.group(3).replace('style="position:absolute;', 'style="position:absolute;top:%spx;' % m.group(2))
+    return re.sub('<h([1-6]) style="[^"]*top: ([0-9]+)px;[^"]*">(.*?)</h\\1>', unwrap, html, flags=re.S)
+
+
+def test_stream_engine_tags_like_the_soup(tmp_path):
+    with open(SAMPLE, errors="surrogateescape") as f:
+        html = unwrap_headings(f.read())
+    assert "<h1" not in html
+    tagged = {}
+    for engine in ("soup", "stream"):
+        path = str(tmp_path / (engine + ".html"))
+        with open(path, "w", errors="surrogateescape") as f:
+            f.write(html)
+        detect_tags(path, engine)
+        with open(path, errors="surrogateescape") as f:
+            tagged[engine] = f.read()
+
+    assert len(re.findall("<h[1-6] ", tagged["stream"])) == 177
+    # The soup serializes the whole document its own way, the stream engine leaves the rest as it was
+    assert str(BeautifulSoup(tagged["stream"], "html.parser")) == tagged["soup"]
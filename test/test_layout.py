@@ -0,0 +1,22 @@
+from layout.manager import find_repeated
+
+
+def test_copies_a_few_pixels_apart_are_repeated():
+    # 101 and 102 used to round into different buckets, neither reaching half the pages
+    tops = [101] * 4 + [102] * 6
+    repeated = find_repeated(["page%d-div" % p for p in range(1, 11)], tops, [90] * 10, ["Fire Code"] * 10)
+    assert repeated.all()
+
+
+def test_page_numbers_and_body_text():
+    pages, tops, lefts, texts = [], [], [], []
+    for p in range(1, 11):
+        # Page numbers, the body lines further apart than the tolerance and a line on two pages only
+        for top, left, text in ((1100, 450, str(p)), (140 + p * 7, 90, "Body text %d" % p), (300, 90, "Twice")):
+            if text != "Twice" or p <= 2:
+                pages.append("page%d-div" % p)
+                tops.append(top)
+                lefts.append(left)
+                texts.append(text)
+    repeated = find_repeated(pages, tops, lefts, texts)
+    assert [t for t, r in zip(texts, repeated) if r] == [str(p) for p in range(1, 11)]
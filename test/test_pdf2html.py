@@ -0,0 +1,62 @@
+import io
+from helpers.pdf2html import _append_html_body, rewrite_html, replace_in_file, embed_image_into_html
+
+OUTLINE = '<hr/>\n<a name="outline"></a><h1>Document Outline</h1>\n<ul>\n<li><a href="#1">Scope</a></li>\n' \
+          '<li><a href="#3">Definitions</a></li>\n</ul>\n<hr/>\n'
+
+
+def chunk(tmp_path, first, last):
+    path = tmp_path / ("%d.html" % first)
+    pages = "".join('<!-- Page %d -->\n<a name="%d"></a>\n<div id="page%d-div">\n<p>Page %d</p>\n<hr/>\n</div>\n'
+                    % (p, p, p, p) for p in range(first, last + 1))
+    path.write_text('<!DOCTYPE html><html>\n<head>\n<title>%d</title>\n</head>\n<body bgcolor="#A0A0A0">\n%s%s'
+                    '</body>\n</html>\n' % (first, pages, OUTLINE))
+    return str(path)
+
+
+def test_stitched_chunks_keep_one_outline_after_the_last_page(tmp_path):
+    chunks = [chunk(tmp_path, 1, 2), chunk(tmp_path, 3, 4), chunk(tmp_path, 5, 5)]
+    out = io.StringIO()
+    for i, path in enumerate(chunks):
+        _append_html_body(path, out, i == 0, i == len(chunks) - 1, ("", ""))
+    html = out.getvalue()
+
+    assert html.count("<body") == html.count("</body>") == 1
+    assert html.count("Document Outline") == 1
+    assert [html.index("Page %d</p>" % p) for p in range(1, 6)] == sorted(html.index("Page %d</p>" % p)
+                                                                          for p in range(1, 6))
+    assert html.index("Page 5</p>") < html.index("Document Outline")
+    # Rules inside the pages stay, only the one introducing a dropped outline goes
+    assert html.count("<hr/>") == 5 + 2
+
+
+def test_chunk_without_outline_keeps_its_last_rule(tmp_path):
+    path = tmp_path / "1.html"
+    path.write_text('<html>\n<head>\n</head>\n<body>\n<p>Page 1</p>\n<hr/>\n</body>\n</html>\n')
+    out = io.StringIO()
+    _append_html_body(str(path), out, False, False, ("", ""))
+    assert out.getvalue() == "<p>Page 1</p>\n<hr/>\n"
+
+
+def test_single_pass_rewrite_matches_the_file_rewrites(tmp_path):
+    images = {}
+    for i in range(3):
+        image = tmp_path / ("doc-%d_1.png" % i)
+        image.write_bytes(bytes(range(i, 256)) * 2)
+        images[image.name] = str(image)
+    body = "".join('<p style="top:%dpx">Text %d</p>\n<img src="%s" width="10"/>\n' % (i * 10, i, name)
+                   for i, name in enumerate(images))
+    html = '<!DOCTYPE html><html>\n<head>\n<title>doc</title>\n</head>\n<body bgcolor="#A0A0A0">\n%s</body>\n' \
+           '</html>\n' % body
+    substitutions = [("<body bgcolor=\"#A0A0A0\"", "<body"), ("<title>.*</title>", "<title>Doc</title>")]
+    before, after = tmp_path / "before.html", tmp_path / "after.html"
+    before.write_text(html)
+    after.write_text(html)
+
+    for old, new in substitutions:
+        replace_in_file(str(before), old, new)
+    for path in images.values():
+        embed_image_into_html(path, str(before))
+    rewrite_html(str(after), substitutions, images)
+
+    assert after.read_bytes() == before.read_bytes()
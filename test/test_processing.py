@@ -0,0 +1,44 @@
+import json
+import os
+import time
+from processing.manager import start_processing, pending_job, job_key
+
+
+def slow_job(seconds):
+    time.sleep(seconds)
+    yield "Slept %ss" % seconds
+
+
+def queued(logf):
+    if not os.path.exists(logf):
+        return 0
+    with open(logf) as f:
+        return sum(json.loads(line)["event"] == "queued" for line in f)
+
+
+def wait_for(condition, timeout=30):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.1)
+
+
+def test_same_request_follows_the_pending_job(tmp_path):
+    pdf = tmp_path / "doc.pdf"
+    pdf.write_bytes(b"%PDF-1.4")
+    logf = str(tmp_path / "doc.pdf.jsonl")
+    key, other_key = job_key(str(pdf)), job_key(str(pdf), {"center_pages": False})
+
+    assert start_processing(slow_job, (1,), "conversion", logf, key) == logf
+    # Other options are another job, it takes the log over
+    start_processing(slow_job, (1,), "conversion", logf, other_key)
+    assert queued(logf) == 2
+    # Clear Log
+    os.remove(logf)
+    assert start_processing(slow_job, (1,), "conversion", logf, key) == logf
+    assert pending_job(key) == logf
+    assert queued(logf) == 0
+
+    wait_for(lambda: pending_job(key) is None and pending_job(other_key) is None)
+    start_processing(slow_job, (1,), "conversion", logf, key)
+    assert queued(logf) == 1
@@ -1,14 +1,56 @@
-from flask import request, redirect, flash
+from flask import Request, request, redirect, flash, jsonify, current_app
 from werkzeug.utils import secure_filename
+from helpers.functions import mkdir_p
+from catalog import manager as catalog
+from config.files import PARTIAL_UPLOAD_TTL
+from collections import OrderedDict
+import threading
+import tempfile
+import hashlib
+import shutil
+import time
+import zlib
+import re
 import os
 
+CHUNK_SIZE = 1024 * 1024
+
+# Running hashes of the partial uploads, by upload id. The least recently used go past
+# PARTIAL_HASHES_MAX, a resumed upload they belonged to is hashed again from disk.
+PARTIAL_HASHES_MAX = 256
+_partial_hashes = OrderedDict()
+_partial_hashes_lock = threading.Lock()
+
+# Uploads share these by a hash of their id, so there are never more than PARTIAL_LOCKS
+PARTIAL_LOCKS = 64
+_partial_locks = [threading.Lock() for _ in range(PARTIAL_LOCKS)]
+
+
+class UploadRequest(Request):
+    """
+        Flask's request_class for the app: when upload_to sets staging_dir, file parts are spooled
+        straight into it, hashed on the way, instead of to a temp file
+    """
+    staging_dir = None
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if self.staging_dir:
+            return HashingFile(self.staging_dir)
+        return super()._get_file_stream(total_content_length, content_type, filename, content_length)
+
 
 def allowed_file(filename, allowed_ext):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in allowed_ext
 
 
-def upload_to(dest, allowed_ext=None):
+def upload_to(dest, allowed_ext=None, store_dir=None):
     if request.method == 'POST':
+        if store_dir:
+            # Have werkzeug spool file parts straight into the store, see UploadRequest
+            staging_dir = os.path.join(store_dir, 'staging')
+            mkdir_p(staging_dir)
+            expire_partials(store_dir)
+            request.staging_dir = staging_dir
         # check if the post request has the file part
         if 'file' not in request.files:
             flash('No file part')
@@ -19,9 +61,164 @@ def upload_to(dest, allowed_ext=None):
             return redirect(request.url)
         if file and (allowed_ext is None or allowed_file(file.filename, allowed_ext)):
             filename = secure_filename(file.filename)
-            file.save(os.path.join(dest, filename))
+            dest_path = catalog.path_for(dest, filename)
+            mkdir_p(os.path.dirname(dest_path))
+            if isinstance(file.stream, HashingFile):
+                file.stream.close()
+                store_file(file.stream.name, file.stream.hexdigest(), store_dir, dest_path)
+            else:
+                file.save(dest_path)
+            catalog.add(dest, filename)
             flash('File successfully uploaded')
             return redirect(request.url)
         else:
+            if isinstance(file.stream, HashingFile):
+                file.stream.close()
+                os.remove(file.stream.name)
             flash('Allowed file types are ' + ','.join(allowed_ext))
             return redirect(request.url)
+
+
+def upload_chunk(dest, store_dir, upload_id, allowed_ext=None):
+    """
+        Resumable upload: the request body is appended to the partial upload at ?offset=N,
+        which has to match what was received so far (GET returns it). ?final=1 on the last
+        chunk moves the upload into the content-addressed store and links it as ?filename=.
+    """
+    if not re.match("^[A-Za-z0-9_-]{1,64}$", upload_id):
+        return jsonify({"error": "Invalid upload id"}), 400
+    partial_dir = os.path.join(store_dir, 'partial')
+    mkdir_p(partial_dir)
+    partial = os.path.join(partial_dir, upload_id)
+
+    if request.method == 'PUT' and not os.path.exists(partial):
+        # Locks partials of its own, a new upload is a good time
+        expire_partials(store_dir)
+
+    with _partial_lock(upload_id):
+        received = os.path.getsize(partial) if os.path.exists(partial) else 0
+        if request.method == 'GET':
+            return jsonify({"offset": received})
+
+        filename = secure_filename(request.args.get('filename', ''))
+        if not filename or (allowed_ext is not None and not allowed_file(filename, allowed_ext)):
+            return jsonify({"error": "Allowed file types are " + ','.join(allowed_ext)}), 400
+        offset = request.args.get('offset', 0, type=int)
+        if offset != received:
+            return jsonify({"error": "Offset mismatch", "offset": received}), 409
+        max_size = current_app.config.get('MAX_CONTENT_LENGTH')
+        if max_size and received + (request.content_length or 0) > max_size:
+            return jsonify({"error": "Upload too large", "offset": received}), 413
+
+        h = _partial_hash(upload_id, partial, received)
+        with open(partial, 'ab') as f:
+            for block in iter(lambda: request.stream.read(CHUNK_SIZE), b''):
+                f.write(block)
+                h.update(block)
+                received += len(block)
+
+        if not request.args.get('final', type=int):
+            _save_partial_hash(upload_id, received, h)
+            return jsonify({"offset": received})
+
+        digest = h.hexdigest()
+        dest_path = catalog.path_for(dest, filename)
+        mkdir_p(os.path.dirname(dest_path))
+        deduplicated = store_file(partial, digest, store_dir, dest_path)
+        catalog.add(dest, filename)
+        return jsonify({"offset": received, "filename": filename, "sha256": digest, "deduplicated": deduplicated})
+
+
+def store_file(temp_path, digest, store_dir, dest_path):
+    """
+        Moves temp_path into the store under its digest (dropping it if the content is already there)
+        and hard links it as dest_path. Returns whether the content was a duplicate.
+    """
+    obj = os.path.join(store_dir, 'objects', digest[:2], digest)
+    duplicate = os.path.exists(obj)
+    if duplicate:
+        os.remove(temp_path)
+    else:
+        mkdir_p(os.path.dirname(obj))
+        os.replace(temp_path, obj)
+
+    if os.path.exists(dest_path):
+        os.remove(dest_path)
+    try:
+        os.link(obj, dest_path)
+    except OSError:
+        shutil.copyfile(obj, dest_path)
+    return duplicate
+
+
+def prune_store(store_dir):
+    """Drops stored content no upload links to anymore"""
+    for root, dirs, files in os.walk(os.path.join(store_dir, 'objects')):
+        for file in files:
+            path = os.path.join(root, file)
+            if os.stat(path).st_nlink == 1:
+                os.remove(path)
+
+
+def expire_partials(store_dir, max_age=PARTIAL_UPLOAD_TTL):
+    """Removes the partial uploads not written to for max_age seconds, and staged files left by failed requests"""
+    cutoff = time.time() - max_age
+    for sub in ('partial', 'staging'):
+        directory = os.path.join(store_dir, sub)
+        if not os.path.isdir(directory):
+            continue
+        for entry in os.scandir(directory):
+            with _partial_lock(entry.name):
+                try:
+                    if entry.stat().st_mtime >= cutoff:
+                        continue
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    continue
+            with _partial_hashes_lock:
+                _partial_hashes.pop(entry.name, None)
+
+
+def _partial_lock(upload_id):
+    return _partial_locks[zlib.crc32(upload_id.encode('utf8')) % PARTIAL_LOCKS]
+
+
+def _save_partial_hash(upload_id, received, h):
+    with _partial_hashes_lock:
+        _partial_hashes[upload_id] = (received, h)
+        _partial_hashes.move_to_end(upload_id)
+        while len(_partial_hashes) > PARTIAL_HASHES_MAX:
+            _partial_hashes.popitem(last=False)
+
+
+def _partial_hash(upload_id, partial, received):
+    with _partial_hashes_lock:
+        saved = _partial_hashes.pop(upload_id, None)
+    if saved is not None and saved[0] == received:
+        return saved[1]
+    # Resuming after a restart (or an upload idle long enough to lose its place), hash what was received once
+    h = hashlib.sha256()
+    if received:
+        with open(partial, 'rb') as f:
+            for block in iter(lambda: f.read(CHUNK_SIZE), b''):
+                h.update(block)
+    return h
+
+
+class HashingFile:
+    """Temporary file that hashes everything written to it"""
+
+    def __init__(self, directory):
+        self.file = tempfile.NamedTemporaryFile(dir=directory, delete=False)
+        self.name = self.file.name
+        self.hash = hashlib.sha256()
+
+    def write(self, data):
+        self.hash.update(data)
+        return self.file.write(data)
+
+    def hexdigest(self):
+        return self.hash.hexdigest()
+
+    def __getattr__(self, item):
+        return getattr(self.file, item)